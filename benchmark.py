@@ -0,0 +1,462 @@
+# benchmark: measure the performance of parts of rawdog.
+# Copyright 2026 The rawdog contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from io import StringIO
+import hashlib
+import heapq
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import feedparser
+
+import testserver
+
+from rawdoglib.articlestore import ArticleStore
+from rawdoglib.persister import COMPRESSORS, dump_state, load_state
+from rawdoglib.rawdog import Article, Config, Feed, HASH_SCHEMES, Rawdog, VERSION, ensure_unicode, fill_template, get_feedparser_args, short_hash, template_re
+
+def interpreted_fill_template(template, bits):
+    """fill_template as it was before templates were compiled, for
+    comparison."""
+    f = StringIO()
+    if_stack = []
+    def write(s):
+        if not False in if_stack:
+            f.write(str(s))
+    for part in template_re.split(str(template)):
+        if part.startswith("__") and part.endswith("__"):
+            key = part[2:-2]
+            if key.startswith("if_"):
+                k = key[3:]
+                if_stack.append(k in bits and bits[k] != "")
+            elif key == "endif":
+                if if_stack != []:
+                    if_stack.pop()
+            elif key == "else":
+                if if_stack != []:
+                    if_stack.append(not if_stack.pop())
+            elif key in bits:
+                write(bits[key])
+        else:
+            write(part)
+    return f.getvalue()
+
+def make_item_bits(i):
+    """Make a plausible set of item template bits."""
+    bits = {
+        "feed_id": "examplefeed%d" % (i % 50),
+        "feed_hash": "%08x" % (i % 50),
+        "feed_title": '<a href="http://example.org/%d/">Example feed %d</a>' % (i % 50, i % 50),
+        "feed_title_no_link": "Example feed %d" % (i % 50),
+        "feed_url": "http://example.org/%d/feed.rss" % (i % 50),
+        "title": '<a href="http://example.org/item%d">Item %d</a>' % (i, i),
+        "title_no_link": "Item %d" % i,
+        "url": "http://example.org/item%d" % i,
+        "guid": "",
+        "hash": "%08x" % i,
+        "author": "",
+        "added": "18:07, Wednesday, 21 January",
+        "date": "",
+        }
+    if i % 3 != 0:
+        bits["description"] = "<p>" + ("Description of item %d. " % i) * 20 + "</p>"
+    else:
+        bits["description"] = ""
+    return bits
+
+def time_it(func, repeat):
+    """Return the best time taken by func over repeat runs, and its
+    result."""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        taken = time.perf_counter() - start
+        if best is None or taken < best:
+            best = taken
+    return best, result
+
+def benchmark_templates(num_items=10000, repeat=5):
+    """Compare interpreted and compiled template expansion for a page of
+    num_items items using the default templates."""
+    config = Config()
+    rawdog = Rawdog()
+    items_bits = [make_item_bits(i) for i in range(num_items)]
+
+    def render(fill):
+        f = StringIO()
+        for bits in items_bits:
+            # As write_article does.
+            f.write(fill(rawdog.get_template(config, "item"), bits))
+        page_bits = {"items": f.getvalue(), "num_items": str(num_items), "version": "benchmark"}
+        return fill(rawdog.get_template(config, "page"), page_bits)
+
+    old_time, old_result = time_it(lambda: render(interpreted_fill_template), repeat)
+    new_time, new_result = time_it(lambda: render(fill_template), repeat)
+    if old_result != new_result:
+        raise AssertionError("Compiled template output differs from interpreted output")
+
+    print("Template expansion, %d items:" % num_items)
+    print("  interpreted: %8.3f s" % old_time)
+    print("  compiled:    %8.3f s" % new_time)
+    print("  speed-up:    %8.2fx" % (old_time / new_time))
+
+def make_feed(feed_num, num_items):
+    """Make a plausible RSS feed."""
+    f = StringIO()
+    f.write('<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"><channel>')
+    f.write("<title>Example feed %d</title><link>http://example.org/%d/</link>" % (feed_num, feed_num))
+    f.write("<description>Example feed %d</description>" % feed_num)
+    for i in range(num_items):
+        f.write("<item><title>Item %d of feed %d</title>" % (i, feed_num))
+        f.write("<link>http://example.org/%d/item%d</link>" % (feed_num, i))
+        f.write("<guid>http://example.org/%d/item%d</guid>" % (feed_num, i))
+        f.write("<dc:creator>Author %d</dc:creator>" % (i % 7))
+        f.write("<pubDate>Wed, 21 Jan 2015 18:%02d:00 GMT</pubDate>" % (i % 60))
+        f.write("<description><![CDATA[<p>%s</p>]]></description></item>"
+                % (("Description of item %d. " % i) * 20))
+    f.write("</channel></rss>")
+    return f.getvalue()
+
+def make_articles(rawdog, num_feeds, items_per_feed, compact=False):
+    """Fill rawdog.articles with articles from num_feeds plausible
+    feeds."""
+    now = time.time()
+    for feed_num in range(num_feeds):
+        url = "http://example.org/%d/feed.rss" % feed_num
+        p = feedparser.parse(make_feed(feed_num, items_per_feed), **get_feedparser_args())
+        p = ensure_unicode(p, "UTF-8")
+        for i, entry_info in enumerate(p["entries"]):
+            article = Article(url, entry_info, now, i)
+            if compact:
+                article.compact()
+            rawdog.articles[article.hash] = article
+
+def benchmark_state(num_feeds=50, items_per_feed=100, repeat=3):
+    """Measure how long it takes to save and load a state with
+    num_feeds * items_per_feed articles using each compression method,
+    and how big the result is."""
+    rawdog = Rawdog()
+    make_articles(rawdog, num_feeds, items_per_feed)
+
+    print("State with %d articles:" % len(rawdog.articles))
+    print("  %-6s %10s %10s %10s" % ("", "save", "load", "size"))
+    for compression in sorted(COMPRESSORS.keys()):
+        save_time, data = time_it(lambda: dump_state(rawdog, compression), repeat)
+        load_time, loaded = time_it(lambda: load_state(data), repeat)
+        if len(loaded.articles) != len(rawdog.articles):
+            raise AssertionError("Loaded state differs from saved state")
+        print("  %-6s %8.3f s %8.3f s %8d K" % (compression, save_time, load_time, len(data) // 1024))
+
+def benchmark_articles(num_feeds=50, items_per_feed=100):
+    """Compare the memory used by full and compact articles, and the
+    size of their pickled state."""
+    print("Articles from %d feeds with %d items each:" % (num_feeds, items_per_feed))
+    print("  %-8s %12s %12s" % ("", "memory", "pickled"))
+    for compact in (False, True):
+        tracemalloc.start()
+        rawdog = Rawdog()
+        make_articles(rawdog, num_feeds, items_per_feed, compact)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        size = len(pickle.dumps(rawdog, pickle.HIGHEST_PROTOCOL))
+        print("  %-8s %10d K %10d K" % (compact and "compact" or "full", used // 1024, size // 1024))
+
+def benchmark_store(num_feeds=50, items_per_feed=100, num_articles=200, repeat=3):
+    """Compare selecting and loading the top num_articles articles from
+    split state files and from an ArticleStore."""
+    config = Config()
+    rawdog = Rawdog()
+    make_articles(rawdog, num_feeds, items_per_feed)
+    by_feed = {}
+    for article in rawdog.articles.values():
+        by_feed.setdefault(article.feed, {})[article.hash] = article
+
+    def from_states(states):
+        # As write_articles does with splitstate, without summaries.
+        found = {}
+        for data in states:
+            articles = load_state(data)
+            for key in heapq.nsmallest(num_articles, [a.get_sort_key(config) for a in articles.values()]):
+                found[key] = articles[key[3]]
+        return [found[key] for key in heapq.nsmallest(num_articles, found.keys())]
+
+    def from_store(basename):
+        store = ArticleStore(basename=basename)
+        store.open()
+        records = store.get_records(by_feed, False, num_articles)
+        result = [store.load(record) for (key, record) in records]
+        store.close()
+        return result
+
+    with tempfile.TemporaryDirectory() as dirname:
+        states = [dump_state(articles) for articles in by_feed.values()]
+        basename = os.path.join(dirname, "articles")
+        store = ArticleStore(basename=basename)
+        for url, articles in by_feed.items():
+            store.set_feed(url, list(articles.values()))
+        store.save(by_feed, False)
+        store.close()
+
+        states_time, states_result = time_it(lambda: from_states(states), repeat)
+        store_time, store_result = time_it(lambda: from_store(basename), repeat)
+    if [a.hash for a in states_result] != [a.hash for a in store_result]:
+        raise AssertionError("Article store selected different articles")
+
+    print("Top %d of %d articles:" % (num_articles, len(rawdog.articles)))
+    print("  feed states: %8.3f s" % states_time)
+    print("  store:       %8.3f s" % store_time)
+    print("  speed-up:    %8.2fx" % (states_time / store_time))
+
+def sha1_initial_hash(article):
+    """Article.compute_initial_hash as it was before hash schemes were
+    added, for comparison."""
+    h = hashlib.sha1()
+    def add_hash(s):
+        h.update(s.encode("UTF-8"))
+
+    add_hash(article.feed)
+    entry_info = article.entry_info
+    if "title" in entry_info:
+        add_hash(entry_info["title"])
+    if "link" in entry_info:
+        add_hash(entry_info["link"])
+    if "content" in entry_info:
+        for content in entry_info["content"]:
+            add_hash(content["value"])
+    if "summary_detail" in entry_info:
+        add_hash(entry_info["summary_detail"]["value"])
+
+    return h.hexdigest()
+
+def benchmark_hashing(num_entries=100000, num_feeds=100, repeat=3):
+    """Measure the time taken to hash num_entries articles when
+    updating, and to get the short hashes of them and their feeds when
+    writing."""
+    feeds = [Feed("http://example.org/%d/feed.rss" % i) for i in range(num_feeds)]
+    articles = []
+    for i in range(num_entries):
+        description = ("Description of item %d. " % i) * 20
+        entry_info = {
+            "title": "Item %d" % i,
+            "link": "http://example.org/item%d" % i,
+            "summary_detail": {"type": "text/html", "value": description},
+            }
+        if i % 3 == 0:
+            entry_info["content"] = [{"type": "text/html", "value": "<p>" + description + "</p>"}]
+        articles.append(Article(feeds[i % num_feeds].url, entry_info, 0, i))
+
+    def hash_all(func):
+        return [func(article) for article in articles]
+
+    print("Hashing %d articles when updating:" % num_entries)
+    old_time, old_result = time_it(lambda: hash_all(sha1_initial_hash), repeat)
+    print("  old sha1:    %8.3f s" % old_time)
+    for scheme in sorted(HASH_SCHEMES.keys()):
+        new_time, new_result = time_it(lambda: hash_all(lambda a: a.compute_initial_hash(scheme)), repeat)
+        if scheme == "sha1" and new_result != old_result:
+            raise AssertionError("SHA-1 hashes differ from old implementation")
+        print("  %-10s   %8.3f s (%.2fx)" % (scheme + ":", new_time, old_time / new_time))
+
+    feeds_by_url = dict([(feed.url, feed) for feed in feeds])
+    def uncached():
+        return [(short_hash(a.feed), short_hash(a.hash)) for a in articles]
+    def cached():
+        return [(feeds_by_url[a.feed].get_short_hash(), a.get_short_hash()) for a in articles]
+    cached()
+
+    print("Short hashes for %d articles when writing:" % num_entries)
+    old_time, old_result = time_it(uncached, repeat)
+    new_time, new_result = time_it(cached, repeat)
+    if old_result != new_result:
+        raise AssertionError("Cached short hashes differ")
+    print("  uncached:    %8.3f s" % old_time)
+    print("  cached:      %8.3f s (%.2fx)" % (new_time, old_time / new_time))
+
+def make_corpus_feed(feed_num, num_items, content_length, generation):
+    """Make a feed for the end-to-end benchmark: RSS for even-numbered
+    feeds and Atom for odd-numbered ones, with num_items items whose
+    descriptions are content_length characters long. Each generation
+    adds a new item and drops the oldest."""
+    f = StringIO()
+    atom = (feed_num % 2 == 1)
+    if atom:
+        f.write('<feed xmlns="http://www.w3.org/2005/Atom">')
+        f.write('<title>Example feed %d</title><link href="http://example.org/%d/"/>' % (feed_num, feed_num))
+        f.write("<id>http://example.org/%d/</id><updated>2015-01-21T18:00:00Z</updated>" % feed_num)
+    else:
+        f.write('<rss version="2.0"><channel>')
+        f.write("<title>Example feed %d</title><link>http://example.org/%d/</link>" % (feed_num, feed_num))
+        f.write("<description>Example feed %d</description>" % feed_num)
+    for i in range(generation + num_items - 1, generation - 1, -1):
+        text = ("Item %d of feed %d. " % (i, feed_num)) * (content_length // 10 + 1)
+        text = text[:content_length]
+        date = (i // 60) % 24, i % 60
+        if atom:
+            f.write('<entry><title>Item %d of feed %d</title>' % (i, feed_num))
+            f.write('<link href="http://example.org/%d/item%d"/>' % (feed_num, i))
+            f.write("<id>http://example.org/%d/item%d</id>" % (feed_num, i))
+            f.write("<updated>2015-01-21T%02d:%02d:00Z</updated>" % date)
+            f.write('<content type="html"><![CDATA[<p>%s</p>]]></content></entry>' % text)
+        else:
+            f.write("<item><title>Item %d of feed %d</title>" % (i, feed_num))
+            f.write("<link>http://example.org/%d/item%d</link>" % (feed_num, i))
+            f.write("<guid>http://example.org/%d/item%d</guid>" % (feed_num, i))
+            f.write("<pubDate>Wed, 21 Jan 2015 %02d:%02d:00 GMT</pubDate>" % date)
+            f.write("<description><![CDATA[<p>%s</p>]]></description></item>" % text)
+    if atom:
+        f.write("</feed>")
+    else:
+        f.write("</channel></rss>")
+    return f.getvalue()
+
+def write_corpus(dirname, num_feeds, num_items, content_length, generation, changed_every=1):
+    """Write every changed_every'th feed of the corpus to dirname."""
+    for feed_num in range(0, num_feeds, changed_every):
+        f = open(os.path.join(dirname, "%d.xml" % feed_num), "w")
+        f.write(make_corpus_feed(feed_num, num_items, content_length, generation))
+        f.close()
+
+def run_rawdog(statedir, action):
+    """Run rawdog with an action, returning the wall-clock time it took
+    and the statistics it recorded."""
+    rawdog = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rawdog")
+    stats_file = os.path.join(statedir, "stats.json")
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, rawdog, "-d", statedir, "--stats", stats_file, action])
+    taken = time.perf_counter() - start
+    f = open(stats_file)
+    stats = json.load(f)
+    f.close()
+    return taken, stats
+
+def benchmark_endtoend(num_feeds=100, num_items=20, content_length=1000, latency=50, changed_percent=10, max_threads=8):
+    """Time rawdog -u and -w end to end on a synthetic corpus of
+    num_feeds feeds served over HTTP with latency milliseconds of delay,
+    for each way of storing the state, with one thread and with
+    max_threads threads. The first update fetches everything; before
+    the second, changed_percent of the feeds get a new item, and the
+    rest return 304 responses."""
+    changed_every = max(1, 100 // max(1, changed_percent))
+    results = {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "parameters": {
+            "num_feeds": num_feeds,
+            "num_items": num_items,
+            "content_length": content_length,
+            "latency": latency,
+            "changed_percent": changed_percent,
+            "max_threads": max_threads,
+            },
+        "runs": [],
+        }
+
+    print("%d feeds with %d items of %d characters, %d ms latency:" % (num_feeds, num_items, content_length, latency))
+    print("  %-12s %7s  %8s %8s %8s %8s" % ("state", "threads", "update", "write", "update", "write"))
+    with tempfile.TemporaryDirectory() as dirname:
+        files_dir = os.path.join(dirname, "files")
+        os.mkdir(files_dir)
+        server = testserver.HTTPServer(None, files_dir, ("127.0.0.1", 0), testserver.HTTPRequestHandler)
+        server.base_url = "http://127.0.0.1:%d" % server.server_address[1]
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        try:
+            for state in ("single", "splitstate", "sqlite"):
+                for threads in sorted(set([1, max_threads])):
+                    statedir = os.path.join(dirname, "%s-%d" % (state, threads))
+                    os.mkdir(statedir)
+                    write_corpus(files_dir, num_feeds, num_items, content_length, 0)
+
+                    # Start from the sample config, as the tests do.
+                    f = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "config"))
+                    config = f.read()
+                    f.close()
+                    config += "\nnumthreads %d\n" % threads
+                    if state == "splitstate":
+                        config += "splitstate true\n"
+                    elif state == "sqlite":
+                        config += "statebackend sqlite\n"
+                    for feed_num in range(num_feeds):
+                        config += "feed 0 %s/delay-%d/%d.xml\n" % (server.base_url, latency, feed_num)
+                    f = open(os.path.join(statedir, "config"), "w")
+                    f.write(config)
+                    f.close()
+
+                    times = []
+                    for action in ("update", "write", "update", "write"):
+                        if action == "update" and times:
+                            write_corpus(files_dir, num_feeds, num_items, content_length, 1, changed_every)
+                        taken, stats = run_rawdog(statedir, "--" + action)
+                        times.append(taken)
+                        results["runs"].append({
+                            "state": state,
+                            "threads": threads,
+                            "action": action,
+                            "warm": len(times) > 2,
+                            "wall": taken,
+                            "total": stats["total"],
+                            "phases": stats["phases"],
+                            "hooks": stats["hooks"],
+                            })
+                    print("  %-12s %7d  %6.3f s %6.3f s %6.3f s %6.3f s" % tuple([state, threads] + times))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    return results
+
+BENCHMARKS = {
+    "articles": benchmark_articles,
+    "endtoend": benchmark_endtoend,
+    "hashing": benchmark_hashing,
+    "state": benchmark_state,
+    "store": benchmark_store,
+    "templates": benchmark_templates,
+    }
+
+def main(args):
+    json_file = None
+    if len(args) >= 2 and args[0] == "--json":
+        json_file = args[1]
+        args = args[2:]
+    if len(args) < 1 or args[0] not in BENCHMARKS:
+        print("Usage: benchmark.py [--json FILE] BENCHMARK [ARG]...")
+        print("Benchmarks: " + " ".join(sorted(BENCHMARKS.keys())))
+        sys.exit(1)
+
+    results = BENCHMARKS[args[0]](*[int(arg) for arg in args[1:]])
+    if json_file is not None:
+        if results is None:
+            print("The %s benchmark doesn't produce JSON results" % args[0])
+            sys.exit(1)
+        f = open(json_file, "w")
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.write("\n")
+        f.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,9 @@
 __all__ = [
+    'articlestore',
+    'asyncfetch',
+    'connpool',
     'feedscanner',
     'persister',
     'rawdog',
+    'timing',
     ]
@@ -0,0 +1,319 @@
+# articlestore: keep articles in a file that can be read lazily.
+# Copyright 2026 The rawdog contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# The store consists of two files. The data file contains each article
+# pickled separately, one after another. The index file contains a
+# header, a pickled table of the feeds in the store, and then one
+# fixed-size record per article, giving the fields that rawdog sorts
+# articles by and where the article is in the data file. The records
+# are kept in output order, so finding the articles to write means
+# reading the start of the index and the data for those articles only;
+# both files are memory-mapped, so nothing else needs to be read.
+#
+# The data file is only ever appended to; records for articles that have
+# changed are added at the end, and the old ones are left behind until
+# there's more dead space than live data, when the live records are
+# copied into a new data file. Each data file has a generation number
+# in its name, and the index says which one it refers to, so replacing
+# the index file is what switches to the new data file.
+
+from collections import namedtuple
+import glob
+import math
+import mmap
+import os
+import pickle
+import struct
+
+from rawdoglib.persister import dump_state, load_state
+
+MAGIC = b"RDAS"
+VERSION = 1
+
+# magic, version, sort order, data file generation, number of records,
+# size of the feed table
+HEADER = struct.Struct("<4sIIIQQ")
+
+# added, date (NaN if None), sequence, offset, length, feed number, hash
+RECORD = struct.Struct("<ddqQII20s")
+
+# Values for the index's sort order.
+SORT_ADDED = 0
+SORT_DATE = 1
+UNSORTED = 2
+
+Record = namedtuple("Record", "added date sequence feed hash offset length")
+
+def get_sort_key(record, sort_by_date):
+	"""Return the sort key for a record, as Article.get_sort_key does."""
+	date = record.added
+	if sort_by_date and record.date:
+		date = record.date
+	return (-date, record.feed, record.sequence, record.hash)
+
+class ArticleStore:
+	"""A memory-mapped store of articles. Each article is described by a
+	Record, and only unpickled when it's loaded."""
+
+	def __init__(self, compression="none", basename="articles"):
+		self.compression = compression
+		self.basename = basename
+		self.index_filename = basename + ".idx"
+
+		self.index_file = None
+		self.index_map = None
+		self.data_file = None
+		self.data_map = None
+		self.append_file = None
+
+		self.sort_order = UNSORTED
+		self.generation = 0
+		self.num_records = 0
+		# The feeds in the index, in order, as (url, count) pairs.
+		self.feed_table = []
+		self.feed_counts = {}
+		self.records_start = 0
+
+		# Records for feeds that have been replaced since the index was
+		# read, indexed by feed URL.
+		self.changed = {}
+
+	def get_data_filename(self, generation):
+		return "%s-%d.dat" % (self.basename, generation)
+
+	def open(self):
+		"""Read the index file, if there is one. If it's missing or
+		unreadable, the store starts off empty."""
+		try:
+			f = open(self.index_filename, "rb")
+		except FileNotFoundError:
+			return
+		try:
+			m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			(magic, version, sort_order, generation, num_records, table_size) = HEADER.unpack_from(m, 0)
+			if magic != MAGIC or version != VERSION:
+				raise ValueError("Not an article store index")
+			start = HEADER.size
+			feed_table = pickle.loads(m[start:start + table_size])
+			records_start = start + table_size
+			if len(m) != records_start + num_records * RECORD.size:
+				raise ValueError("Article store index is truncated")
+		except (ValueError, struct.error, pickle.UnpicklingError, EOFError):
+			f.close()
+			return
+
+		self.index_file = f
+		self.index_map = m
+		self.sort_order = sort_order
+		self.generation = generation
+		self.num_records = num_records
+		self.feed_table = feed_table
+		self.feed_counts = dict(feed_table)
+		self.records_start = records_start
+
+	def close(self):
+		"""Close the store's files, discarding any changes that haven't
+		been saved."""
+		for name in ("index_map", "index_file", "data_map", "data_file", "append_file"):
+			obj = getattr(self, name)
+			if obj is not None:
+				obj.close()
+				setattr(self, name, None)
+
+	def has_feed(self, url):
+		"""Return True if the store has a (possibly empty) set of
+		articles for feed url."""
+		return url in self.changed or url in self.feed_counts
+
+	def get_count(self, feeds):
+		"""Return the number of articles in the store that belong to
+		the feeds in the collection feeds."""
+		count = 0
+		for url in feeds:
+			if url in self.changed:
+				count += len(self.changed[url])
+			else:
+				count += self.feed_counts.get(url, 0)
+		return count
+
+	def set_feed(self, url, articles):
+		"""Replace the articles for feed url with articles. The articles
+		are written to the end of the data file immediately, but won't
+		be used until the store is saved."""
+		if self.append_file is None:
+			self.append_file = open(self.get_data_filename(self.generation), "ab")
+		f = self.append_file
+
+		records = []
+		for article in articles:
+			data = dump_state(article, self.compression)
+			offset = f.tell()
+			f.write(data)
+			records.append(Record(article.added, article.date, article.sequence,
+			                      url, article.hash, offset, len(data)))
+		self.changed[url] = records
+
+	def iter_index(self, feeds=None):
+		"""Yield the records in the index, in index order, skipping
+		feeds that have been changed or aren't in feeds."""
+		if self.index_map is None:
+			return
+		urls = [url for (url, count) in self.feed_table]
+		wanted = [(url not in self.changed and (feeds is None or url in feeds))
+		          for url in urls]
+		m = self.index_map
+		for pos in range(self.records_start, self.records_start + self.num_records * RECORD.size, RECORD.size):
+			(added, date, sequence, offset, length, feed_num, digest) = RECORD.unpack_from(m, pos)
+			if not wanted[feed_num]:
+				continue
+			if math.isnan(date):
+				date = None
+			yield Record(added, date, sequence, urls[feed_num], digest.hex(), offset, length)
+
+	def get_records(self, feeds, sort_by_date, limit=None):
+		"""Return a list of (sort key, record) pairs for the articles that
+		belong to the feeds in feeds. If limit is given, return only the
+		first limit articles in sort order; otherwise return all of them,
+		in no particular order."""
+		if limit is not None and not self.changed and self.sort_order == get_sort_order(sort_by_date):
+			# The index is already in the right order, so we
+			# only need to read the start of it.
+			result = []
+			for record in self.iter_index(feeds):
+				if len(result) == limit:
+					break
+				result.append((get_sort_key(record, sort_by_date), record))
+			return result
+
+		result = [(get_sort_key(record, sort_by_date), record) for record in self.iter_index(feeds)]
+		for url, records in self.changed.items():
+			if url in feeds:
+				result += [(get_sort_key(record, sort_by_date), record) for record in records]
+		if limit is not None:
+			result.sort()
+			del result[limit:]
+		return result
+
+	def needs_save(self, sort_by_date):
+		"""Return True if the store has unsaved changes, or its index
+		isn't sorted in the order that sort_by_date asks for."""
+		return self.changed != {} or self.sort_order != get_sort_order(sort_by_date)
+
+	def map_data(self, end):
+		"""Make sure the data file is mapped at least up to end."""
+		if self.data_map is None or len(self.data_map) < end:
+			if self.append_file is not None:
+				self.append_file.flush()
+			if self.data_map is not None:
+				self.data_map.close()
+				self.data_file.close()
+			self.data_file = open(self.get_data_filename(self.generation), "rb")
+			self.data_map = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def read_data(self, record):
+		"""Return the pickled data for a record."""
+		end = record.offset + record.length
+		self.map_data(end)
+		return self.data_map[record.offset:end]
+
+	def load(self, record):
+		"""Load the article that a record describes."""
+		return load_state(self.read_data(record))
+
+	def save(self, feeds, sort_by_date):
+		"""Write a new index containing the articles for the feeds in
+		feeds, sorted into output order, and then reopen the store. If
+		more than half the data file is no longer used, copy the live
+		records into a new one."""
+		records = self.get_records(feeds, sort_by_date)
+		records.sort()
+
+		if self.append_file is not None:
+			self.append_file.close()
+			self.append_file = None
+		data_filename = self.get_data_filename(self.generation)
+		try:
+			data_size = os.stat(data_filename).st_size
+		except FileNotFoundError:
+			data_size = 0
+		live_size = sum([record.length for (key, record) in records])
+
+		generation = self.generation
+		if data_size > 2 * live_size:
+			generation += 1
+			new_filename = self.get_data_filename(generation)
+			newfile = open(new_filename + ".new", "wb")
+			new_records = []
+			for (key, record) in records:
+				data = self.read_data(record)
+				new_records.append((key, record._replace(offset=newfile.tell())))
+				newfile.write(data)
+			newfile.close()
+			os.rename(new_filename + ".new", new_filename)
+			records = new_records
+
+		feed_table = []
+		feed_nums = {}
+		for (key, record) in records:
+			if record.feed not in feed_nums:
+				feed_nums[record.feed] = len(feed_table)
+				feed_table.append([record.feed, 0])
+			feed_table[feed_nums[record.feed]][1] += 1
+		for url in sorted(self.feed_counts.keys() | self.changed.keys()):
+			if url in feeds and url not in feed_nums:
+				# Keep track of feeds with no articles.
+				feed_nums[url] = len(feed_table)
+				feed_table.append([url, 0])
+		table = pickle.dumps([tuple(item) for item in feed_table], pickle.HIGHEST_PROTOCOL)
+
+		newname = "%s.new-%d" % (self.index_filename, os.getpid())
+		newfile = open(newname, "wb")
+		newfile.write(HEADER.pack(MAGIC, VERSION, get_sort_order(sort_by_date), generation, len(records), len(table)))
+		newfile.write(table)
+		for (key, record) in records:
+			date = record.date
+			if date is None:
+				date = math.nan
+			newfile.write(RECORD.pack(record.added, date, record.sequence, record.offset,
+			                          record.length, feed_nums[record.feed], bytes.fromhex(record.hash)))
+		newfile.close()
+		os.rename(newname, self.index_filename)
+
+		self.close()
+		self.remove_data_files(generation)
+		self.__init__(self.compression, self.basename)
+		self.open()
+
+	def remove_data_files(self, keep=None):
+		"""Remove data files other than the one for generation keep."""
+		for filename in glob.glob(self.basename + "-*.dat"):
+			if keep is None or filename != self.get_data_filename(keep):
+				os.unlink(filename)
+
+	def delete(self):
+		"""Remove the store's files, if they exist."""
+		self.close()
+		try:
+			os.unlink(self.index_filename)
+		except FileNotFoundError:
+			pass
+		self.remove_data_files()
+
+def get_sort_order(sort_by_date):
+	if sort_by_date:
+		return SORT_DATE
+	else:
+		return SORT_ADDED
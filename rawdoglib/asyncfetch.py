@@ -0,0 +1,355 @@
+# asyncfetch: fetch feeds over HTTP concurrently using asyncio.
+# Copyright 2026 The rawdog contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# This is a deliberately minimal HTTP/1.1 client: it only does GET
+# requests, and it leaves anything complicated (proxies, FTP, unusual
+# authentication schemes) to urllib. The caller is expected to check
+# can_fetch first, and use urllib for URLs that this can't handle.
+
+import asyncio
+import base64
+import gzip
+import socket
+import ssl
+import urllib.parse
+import urllib.request
+import zlib
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+
+class HTTPProtocolError(IOError):
+	"""The server's response couldn't be understood as HTTP."""
+	pass
+
+class Response:
+	"""The response to an HTTP request, after following any redirects."""
+
+	def __init__(self, url, status, headers, data, history):
+		# The URL the data was retrieved from.
+		self.url = url
+		# The status code of the final response.
+		self.status = status
+		# The headers of the final response, with lowercase names.
+		self.headers = headers
+		# The (decompressed) body of the final response.
+		self.data = data
+		# A list of dicts describing each response received, in the
+		# same format as rawdog's ResponseLogProcessor.
+		self.history = history
+
+class Unlimited:
+	"""Async context manager that doesn't limit anything."""
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, type, value, tb):
+		return False
+
+class ConnectionPool:
+	"""A pool of idle connections, keyed by scheme, host and port. Since
+	all the requests are made from the same event loop, this doesn't
+	need any locking."""
+
+	def __init__(self):
+		self.idle = {}
+		# The number of connections opened, and the number of
+		# requests that reused an existing connection.
+		self.opened = 0
+		self.reused = 0
+
+	def get(self, key):
+		"""Return an idle (reader, writer) pair for key, or None if
+		there isn't one."""
+		conns = self.idle.get(key)
+		while conns:
+			(reader, writer) = conns.pop()
+			if not (reader.at_eof() or writer.is_closing()):
+				return (reader, writer)
+			writer.close()
+		return None
+
+	def put(self, key, conn):
+		"""Return a connection to the pool."""
+		self.idle.setdefault(key, []).append(conn)
+
+	def close(self):
+		"""Close all the idle connections."""
+		for conns in self.idle.values():
+			for (reader, writer) in conns:
+				writer.close()
+		self.idle = {}
+
+class HostLimiter:
+	"""Limit the number of concurrent requests made to each host."""
+
+	def __init__(self, max_per_host):
+		self.max_per_host = max_per_host
+		self.semaphores = {}
+
+	def get(self, host):
+		"""Return an async context manager that must be held while
+		making a request to host."""
+		if self.max_per_host <= 0:
+			return Unlimited()
+		sem = self.semaphores.get(host)
+		if sem is None:
+			sem = asyncio.Semaphore(self.max_per_host)
+			self.semaphores[host] = sem
+		return sem
+
+def can_fetch(url):
+	"""Return True if url can be fetched by this module, or False if it
+	should be left to urllib."""
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme not in ("http", "https") or not parts.hostname:
+		return False
+
+	# Proxies are urllib's problem.
+	proxies = urllib.request.getproxies()
+	if parts.scheme in proxies and not urllib.request.proxy_bypass(parts.hostname):
+		return False
+
+	return True
+
+def decode_body(data, headers):
+	"""Undo any Content-Encoding that the server has applied."""
+	encoding = headers.get("content-encoding", "")
+	if data and "gzip" in encoding:
+		data = gzip.decompress(data)
+	elif data and "deflate" in encoding:
+		try:
+			data = zlib.decompress(data)
+		except zlib.error:
+			# The data may have no headers and no checksum.
+			data = zlib.decompress(data, -15)
+	return data
+
+async def with_timeout(aw, timeout):
+	"""Await aw, raising socket.timeout if it takes longer than timeout
+	seconds."""
+	try:
+		return await asyncio.wait_for(aw, timeout)
+	except asyncio.TimeoutError:
+		raise socket.timeout("timed out")
+
+async def read_headers(reader, timeout):
+	"""Read an HTTP status line and headers. Return the HTTP version, the
+	status code and a dict of headers with lowercase names."""
+	while True:
+		line = await with_timeout(reader.readline(), timeout)
+		if line == b"":
+			raise HTTPProtocolError("Connection closed without a response")
+		bits = line.decode("ISO-8859-1").split(None, 2)
+		if len(bits) < 2 or not bits[0].startswith("HTTP/"):
+			raise HTTPProtocolError("Bad status line: " + repr(line))
+		try:
+			status = int(bits[1])
+		except ValueError:
+			raise HTTPProtocolError("Bad status line: " + repr(line))
+
+		headers = {}
+		while True:
+			line = await with_timeout(reader.readline(), timeout)
+			line = line.decode("ISO-8859-1").rstrip("\r\n")
+			if line == "":
+				break
+			if ":" not in line:
+				continue
+			name, value = line.split(":", 1)
+			headers[name.strip().lower()] = value.strip()
+
+		# Skip over any informational responses.
+		if status >= 200 or status == 101:
+			return bits[0], status, headers
+
+async def read_body(reader, status, headers, timeout):
+	"""Read the body of a response."""
+	if status in (204, 304) or status < 200:
+		return b""
+
+	if "chunked" in headers.get("transfer-encoding", "").lower():
+		chunks = []
+		while True:
+			line = await with_timeout(reader.readline(), timeout)
+			try:
+				size = int(line.split(b";", 1)[0].strip(), 16)
+			except ValueError:
+				raise HTTPProtocolError("Bad chunk size: " + repr(line))
+			if size == 0:
+				break
+			chunks.append(await with_timeout(reader.readexactly(size), timeout))
+			await with_timeout(reader.readline(), timeout)
+		# Discard any trailers.
+		while True:
+			line = await with_timeout(reader.readline(), timeout)
+			if line in (b"\r\n", b"\n", b""):
+				break
+		return b"".join(chunks)
+
+	length = headers.get("content-length")
+	if length is not None:
+		try:
+			length = int(length)
+		except ValueError:
+			length = None
+	if length is not None:
+		return await with_timeout(reader.readexactly(length), timeout)
+
+	chunks = []
+	while True:
+		chunk = await with_timeout(reader.read(65536), timeout)
+		if chunk == b"":
+			break
+		chunks.append(chunk)
+	return b"".join(chunks)
+
+def can_reuse(version, status, headers):
+	"""Return True if a connection can be used for another request after
+	reading a response."""
+	connection = headers.get("connection", "").lower()
+	if version == "HTTP/1.0":
+		if connection != "keep-alive":
+			return False
+	elif connection == "close":
+		return False
+
+	# The end of the body must have been marked by something other
+	# than closing the connection.
+	if status in (204, 304) or status < 200:
+		return True
+	if "chunked" in headers.get("transfer-encoding", "").lower():
+		return True
+	try:
+		int(headers.get("content-length"))
+		return True
+	except (TypeError, ValueError):
+		return False
+
+async def request(url, headers, timeout, limiter, pool=None):
+	"""Make a single GET request. Return the status code, headers and
+	body. If pool is not None, it is a ConnectionPool to keep the
+	connection in afterwards."""
+	parts = urllib.parse.urlsplit(url)
+	https = (parts.scheme == "https")
+	host = parts.hostname
+	port = parts.port
+	if port is None:
+		port = 443 if https else 80
+
+	path = parts.path or "/"
+	if parts.query:
+		path += "?" + parts.query
+
+	lines = ["GET " + path + " HTTP/1.1",
+	         "Host: " + parts.netloc.rpartition("@")[2]]
+	names = set()
+	for name, value in headers:
+		names.add(name.lower())
+		lines.append(name + ": " + value)
+	if parts.username is not None and "authorization" not in names:
+		# Inline user:password credentials, as feedparser supports.
+		auth = "%s:%s" % (urllib.parse.unquote(parts.username),
+		                  urllib.parse.unquote(parts.password or ""))
+		lines.append("Authorization: Basic "
+		             + base64.b64encode(auth.encode("UTF-8")).decode("ASCII"))
+	if pool is None:
+		lines.append("Connection: close")
+	else:
+		lines.append("Connection: keep-alive")
+	req = ("\r\n".join(lines) + "\r\n\r\n").encode("ISO-8859-1")
+
+	context = None
+	if https:
+		context = ssl.create_default_context()
+
+	key = (parts.scheme, host, port)
+	async with limiter.get(host):
+		while True:
+			conn = None
+			if pool is not None:
+				conn = pool.get(key)
+			reused = (conn is not None)
+			if conn is None:
+				conn = await with_timeout(asyncio.open_connection(host, port, ssl=context), timeout)
+			reader, writer = conn
+
+			keep = False
+			try:
+				writer.write(req)
+				await with_timeout(writer.drain(), timeout)
+				version, status, resp_headers = await read_headers(reader, timeout)
+				data = await read_body(reader, status, resp_headers, timeout)
+				keep = (pool is not None and can_reuse(version, status, resp_headers))
+			except (OSError, asyncio.IncompleteReadError) as e:
+				if reused and not isinstance(e, socket.timeout):
+					# The server has probably closed the
+					# idle connection. Try again.
+					continue
+				raise
+			finally:
+				if keep:
+					pool.put(key, conn)
+				else:
+					writer.close()
+			break
+
+	if pool is not None:
+		if reused:
+			pool.reused += 1
+		else:
+			pool.opened += 1
+
+	return status, resp_headers, decode_body(data, resp_headers)
+
+async def fetch(url, headers, timeout, limiter=None, pool=None):
+	"""Fetch url, following redirects, and return a Response.
+
+	headers is a list of (name, value) pairs to send with each request.
+	timeout is the maximum time in seconds to wait for any network
+	operation. limiter is a HostLimiter (or None for no limit). pool is
+	a ConnectionPool to reuse connections from (or None to close each
+	connection after use)."""
+	if limiter is None:
+		limiter = HostLimiter(0)
+
+	history = []
+	while True:
+		status, resp_headers, data = await request(url, headers, timeout, limiter, pool)
+
+		entry = {
+			"url": url,
+			"status": status,
+			}
+		location = resp_headers.get("location")
+		if location is not None:
+			entry["location"] = location
+		retry_after = resp_headers.get("retry-after")
+		if retry_after is not None:
+			entry["retry_after"] = retry_after
+		history.append(entry)
+
+		if status not in REDIRECT_CODES or location is None:
+			break
+		if len(history) > MAX_REDIRECTS:
+			raise HTTPProtocolError("Too many redirects")
+		newurl = urllib.parse.urljoin(url, location)
+		if urllib.parse.urlsplit(newurl).scheme not in ("http", "https"):
+			break
+		url = urllib.parse.urldefrag(newurl)[0]
+
+	return Response(url, status, resp_headers, data, history)
@@ -0,0 +1,195 @@
+# connpool: reuse HTTP connections between urllib requests.
+# Copyright 2026 The rawdog contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# urllib's HTTP handlers send "Connection: close" with every request.
+# The handlers here instead keep the connection open once the response
+# has been read, and put it in a ConnectionPool so that the next request
+# to the same server (from any thread) can use it.
+
+import http.client
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+class ConnectionPool:
+	"""A thread-safe pool of idle HTTP connections. Connections are keyed
+	by scheme and host:port -- which will be the proxy's, for requests
+	made through an HTTP proxy."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.idle = {}
+		self.closed = False
+		# The number of connections opened, and the number of
+		# requests that reused an existing connection.
+		self.opened = 0
+		self.reused = 0
+
+	def get(self, key):
+		"""Return an idle connection for key, or None if there isn't
+		one."""
+		with self.lock:
+			conns = self.idle.get(key)
+			if conns:
+				return conns.pop()
+		return None
+
+	def put(self, key, conn):
+		"""Return a connection to the pool once it's idle."""
+		with self.lock:
+			if not self.closed:
+				self.idle.setdefault(key, []).append(conn)
+				return
+		conn.close()
+
+	def count(self, reused):
+		"""Record that a request has been made."""
+		with self.lock:
+			if reused:
+				self.reused += 1
+			else:
+				self.opened += 1
+
+	def close(self):
+		"""Close all the idle connections. Connections that are
+		returned to the pool after this will be closed too."""
+		with self.lock:
+			idle = self.idle
+			self.idle = {}
+			self.closed = True
+		for conns in idle.values():
+			for conn in conns:
+				conn.close()
+
+	def get_handlers(self, handlers=[]):
+		"""Return a list of urllib2 handlers that use this pool, to add
+		to the list of handlers. If handlers already contains a handler
+		that opens HTTP (or HTTPS) URLs, it's left to do so."""
+		result = []
+		if not any(hasattr(h, "http_open") for h in handlers):
+			result.append(PooledHTTPHandler(self))
+		if not any(hasattr(h, "https_open") for h in handlers):
+			result.append(PooledHTTPSHandler(self))
+		return result
+
+class PooledResponse(http.client.HTTPResponse):
+	"""An HTTPResponse that calls its release method when it's closed,
+	so that its connection can be reused."""
+
+	release = None
+	finished_chunks = False
+
+	def _read_and_discard_trailer(self):
+		# This is only called once the last chunk has been read.
+		http.client.HTTPResponse._read_and_discard_trailer(self)
+		self.finished_chunks = True
+
+	def _close_conn(self):
+		http.client.HTTPResponse._close_conn(self)
+		release = self.release
+		if release is not None:
+			self.release = None
+			release(self)
+
+	def can_reuse(self):
+		"""Return True if the whole response has been read, and the
+		server is expecting another request on the connection."""
+		if self.will_close:
+			return False
+		elif self.chunked:
+			return self.finished_chunks
+		else:
+			return self.length == 0
+
+def pooled_open(handler, http_class, req, **kwargs):
+	"""Make a request using a connection from handler's pool, as
+	urllib.request.AbstractHTTPHandler.do_open does with a new
+	connection."""
+	if not req.host:
+		raise urllib.error.URLError("no host given")
+	if req._tunnel_host:
+		# Connections tunnelled through a proxy aren't pooled.
+		return handler.do_open(http_class, req, **kwargs)
+
+	pool = handler.pool
+	key = (req.type, req.host)
+
+	headers = dict(req.unredirected_hdrs)
+	headers.update(dict([(k, v) for k, v in req.headers.items() if k not in headers]))
+	headers["Connection"] = "keep-alive"
+	headers = dict([(name.title(), value) for name, value in headers.items()])
+
+	while True:
+		conn = pool.get(key)
+		reused = (conn is not None)
+		if conn is None:
+			conn = http_class(req.host, timeout=req.timeout, **kwargs)
+			conn.response_class = PooledResponse
+		else:
+			conn.timeout = req.timeout
+			if conn.sock is not None:
+				timeout = req.timeout
+				if not isinstance(timeout, (int, float)):
+					# It's the "use the default" marker.
+					timeout = socket.getdefaulttimeout()
+				conn.sock.settimeout(timeout)
+
+		try:
+			conn.request(req.get_method(), req.selector, req.data, headers,
+			             encode_chunked=req.has_header("Transfer-encoding"))
+			response = conn.getresponse()
+		except (OSError, http.client.HTTPException) as e:
+			conn.close()
+			if reused and not isinstance(e, socket.timeout):
+				# The server has probably closed the idle
+				# connection. Try again.
+				continue
+			raise urllib.error.URLError(e)
+		break
+
+	pool.count(reused)
+
+	def release(response):
+		if response.can_reuse():
+			pool.put(key, conn)
+		else:
+			conn.close()
+	response.release = release
+
+	response.url = req.get_full_url()
+	response.msg = response.reason
+	return response
+
+class PooledHTTPHandler(urllib.request.HTTPHandler):
+	"""An HTTPHandler that reuses connections from a ConnectionPool."""
+
+	def __init__(self, pool):
+		urllib.request.HTTPHandler.__init__(self)
+		self.pool = pool
+
+	def http_open(self, req):
+		return pooled_open(self, http.client.HTTPConnection, req)
+
+class PooledHTTPSHandler(urllib.request.HTTPSHandler):
+	"""An HTTPSHandler that reuses connections from a ConnectionPool."""
+
+	def __init__(self, pool):
+		urllib.request.HTTPSHandler.__init__(self)
+		self.pool = pool
+
+	def https_open(self, req):
+		return pooled_open(self, http.client.HTTPSConnection, req, context=self._context)
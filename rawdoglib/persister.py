@@ -1,5 +1,6 @@
 # persister: persist Python objects safely to pickle files
 # Copyright 2003, 2004, 2005, 2013, 2014 Adam Sampson <ats@offog.org>
+# Copyright 2026 The rawdog contributors
 #
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,22 +18,109 @@
 import pickle as pickle
 import errno
 import fcntl
+import glob
+import gzip
+import hashlib
+import lzma
 import os
+import sqlite3
 import sys
+import zlib
+
+import rawdoglib.timing
+
+# Ways of compressing pickled state files.
+COMPRESSORS = {
+	"none": lambda data: data,
+	"gzip": lambda data: gzip.compress(data, 6),
+	"zlib": lambda data: zlib.compress(data, 6),
+	"lzma": lambda data: lzma.compress(data),
+	}
+
+def dump_state(obj, compression="none"):
+	"""Pickle an object, compressing the result using one of the
+	methods in COMPRESSORS."""
+	return COMPRESSORS[compression](pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+def decompress_state(data):
+	"""Return the pickle from data written by dump_state, working out
+	from the data which compression method was used."""
+	if data.startswith(b"\x1f\x8b"):
+		data = gzip.decompress(data)
+	elif data.startswith(b"\xfd7zXZ\x00"):
+		data = lzma.decompress(data)
+	elif data.startswith(b"\x78"):
+		# A pickle can't start with this byte, so it must be zlib.
+		data = zlib.decompress(data)
+	return data
+
+def load_state(data):
+	"""Unpickle an object written by dump_state."""
+	return pickle.loads(decompress_state(data))
+
+def load_state_file(filename):
+	"""Load an object from a state file written by dump_state."""
+	f = open(filename, "rb")
+	try:
+		return load_state(f.read())
+	finally:
+		f.close()
 
 class Persistable:
 	"""An object which can be persisted."""
 
+	# The names of dict attributes that should be stored as tables, one
+	# row per item, by the SQLite backend. Items that are added, changed
+	# or removed must be marked using row_modified or table_modified, or
+	# the SQLite backend won't save them.
+	persist_tables = ()
+
 	def __init__(self):
 		self._modified = False
+		self._modified_rows = {}
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state.pop("_modified_rows", None)
+		return state
 
 	def modified(self, state=True):
-		"""Mark the object as having been modified (or not)."""
+		"""Mark the object as having been modified (or not). Marking it
+		as not modified also forgets which rows were modified."""
 		self._modified = state
+		if not state:
+			self._modified_rows = {}
 
 	def is_modified(self):
 		return self._modified
 
+	def row_modified(self, table, key):
+		"""Mark the item key in the persist_tables dict table as having
+		been added, changed or removed, and the object as modified."""
+		self._modified = True
+		rows = self.get_modified_rows(table)
+		if rows is not None:
+			rows.add(key)
+
+	def table_modified(self, table):
+		"""Mark every item in the persist_tables dict table as possibly
+		having been changed, and the object as modified."""
+		self._modified = True
+		self._get_modified_rows()[table] = None
+
+	def get_modified_rows(self, table):
+		"""Return the set of keys of the items in table that have been
+		marked as modified, or None if they all might have been."""
+		return self._get_modified_rows().setdefault(table, set())
+
+	def _get_modified_rows(self):
+		# Objects loaded from pickles don't have this.
+		try:
+			return self._modified_rows
+		except AttributeError:
+			self._modified_rows = {}
+			return self._modified_rows
+
 class Persisted:
 	"""Context manager for a persistent object.  The object being persisted
 	must implement the Persistable interface."""
@@ -86,32 +174,28 @@ class Persisted:
 			return self.object
 
 		try:
-			self._open(no_block)
+			with rawdoglib.timing.phase("state_load"):
+				self._open(no_block)
 		except KeyboardInterrupt:
 			sys.exit(1)
 		except:
-			print("An error occurred while reading state from " + os.path.abspath(self.filename) + ".")
+			print("An error occurred while reading state from " + self.location() + ".")
 			print("This usually means the file is corrupt, and removing it will fix the problem.")
 			sys.exit(1)
 
 		self.refcount = 1
 		return self.object
 
+	def location(self):
+		"""Describe where the object is stored, for error messages."""
+		return os.path.abspath(self.filename)
+
 	def _get_lock(self, no_block):
 		if not self.persister.use_locking:
 			return True
 
-		self.lock_file = open(self.filename + ".lock", "w+")
-		try:
-			mode = fcntl.LOCK_EX
-			if no_block:
-				mode |= fcntl.LOCK_NB
-			fcntl.lockf(self.lock_file.fileno(), mode)
-		except IOError as e:
-			if no_block and e.errno in (errno.EACCES, errno.EAGAIN):
-				return False
-			raise e
-		return True
+		self.lock_file = get_lock(self.filename + ".lock", no_block)
+		return self.lock_file is not None
 
 	def _open(self, no_block):
 		self.persister.log("Loading state file: ", self.filename)
@@ -128,9 +212,26 @@ class Persisted:
 			self.object.modified()
 			return
 
-		self.object = pickle.load(f)
-		self.object.modified(False)
+		data = f.read()
 		f.close()
+		self.object = load_state(data)
+		self.object.modified(False)
+
+	def save(self):
+		"""Save the persisted object back to its file now if it's been
+		modified, without closing it."""
+		if self.object.is_modified():
+			self._save()
+			self.object.modified(False)
+
+	def _save(self):
+		self.persister.log("Saving state file: ", self.filename)
+		with rawdoglib.timing.phase("state_save"):
+			newname = "%s.new-%d" % (self.filename, os.getpid())
+			newfile = open(newname, "w+b")
+			newfile.write(dump_state(self.object, self.persister.compression))
+			newfile.close()
+			os.rename(newname, self.filename)
 
 	def close(self):
 		"""Reduce the reference count of the persisted object, saving
@@ -142,15 +243,245 @@ class Persisted:
 			return
 
 		if self.object.is_modified():
-			self.persister.log("Saving state file: ", self.filename)
-			newname = "%s.new-%d" % (self.filename, os.getpid())
-			newfile = open(newname, "w+b")
-			pickle.dump(self.object, newfile, pickle.HIGHEST_PROTOCOL)
-			newfile.close()
-			os.rename(newname, self.filename)
+			self._save()
+
+		if self.lock_file is not None:
+			self.lock_file.close()
+		self.persister._remove(self.filename)
+
+def get_lock(filename, no_block):
+	"""Open and lock a lock file, returning the open file. If no_block is
+	True, return None if the file is already locked."""
+	lock_file = open(filename, "w+")
+	try:
+		mode = fcntl.LOCK_EX
+		if no_block:
+			mode |= fcntl.LOCK_NB
+		fcntl.lockf(lock_file.fileno(), mode)
+	except IOError as e:
+		lock_file.close()
+		if no_block and e.errno in (errno.EACCES, errno.EAGAIN):
+			return None
+		raise e
+	return lock_file
+
+def get_digest(data):
+	return hashlib.sha1(data).digest()
+
+class StateDatabase:
+	"""An SQLite database containing a set of persisted objects.
+
+	Each object is identified by the filename it would have been stored
+	in by Persisted (its "scope"). Each of the dicts named in the
+	object's persist_tables is stored as a table with one row per item,
+	and the rest of the object is stored in the objects table. When an
+	object is saved, only the rows that have changed since it was loaded
+	are written; the object must mark the rows of its tables that it's
+	changed using row_modified or table_modified. Rows are compressed in
+	the same way as pickled state files."""
+
+	def __init__(self, filename, lock_filename, persister):
+		self.filename = filename
+		self.lock_filename = lock_filename
+		self.persister = persister
+		self.connection = None
+		self.lock_file = None
+		self.refcount = 0
+		self.tables = set()
+
+	def open(self, no_block):
+		"""Open the database, if it isn't already open. Return False if
+		no_block is True and the database is locked by another
+		process."""
+
+		if self.refcount > 0:
+			self.refcount += 1
+			return True
+
+		if self.persister.use_locking:
+			self.lock_file = get_lock(self.lock_filename + ".lock", no_block)
+			if self.lock_file is None:
+				return False
+
+		self.persister.log("Opening state database: ", self.filename)
+		is_new = not os.path.exists(self.filename)
+		self.connection = sqlite3.connect(self.filename)
+		self.connection.execute("PRAGMA journal_mode = WAL")
+		self.connection.execute("PRAGMA synchronous = NORMAL")
+		with self.connection:
+			self.connection.execute("CREATE TABLE IF NOT EXISTS objects (scope TEXT PRIMARY KEY, data BLOB NOT NULL)")
+		self.refcount = 1
+
+		if is_new:
+			self.import_files()
+		return True
 
+	def close(self):
+		self.refcount -= 1
+		if self.refcount > 0:
+			return
+
+		self.connection.close()
+		self.connection = None
 		if self.lock_file is not None:
 			self.lock_file.close()
+			self.lock_file = None
+
+	def import_files(self):
+		"""Import any existing pickled state files into a newly-created
+		database."""
+		filenames = [self.lock_filename] + sorted(glob.glob("feeds/*.state"))
+		imported = []
+		for filename in filenames:
+			try:
+				obj = load_state_file(filename)
+			except IOError:
+				continue
+			self.persister.log("Importing state file: ", filename)
+			for table in obj.persist_tables:
+				obj.table_modified(table)
+			self.save(filename, obj, {})
+			imported.append(filename)
+
+		# Move the imported files out of the way, so that they can't
+		# be loaded by mistake (as out-of-date state) later.
+		for filename in imported:
+			os.rename(filename, filename + ".imported")
+
+	def ensure_table(self, table):
+		if table in self.tables:
+			return
+		with self.connection:
+			self.connection.execute("CREATE TABLE IF NOT EXISTS %s (scope TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (scope, key))" % table)
+		self.tables.add(table)
+
+	def load(self, scope, digests):
+		"""Load the object stored as scope, or return None if it
+		doesn't exist. The digests of the rows loaded are stored in
+		the dict digests."""
+
+		row = self.connection.execute("SELECT data FROM objects WHERE scope = ?", (scope,)).fetchone()
+		if row is None:
+			return None
+
+		data = decompress_state(row[0])
+		obj = pickle.loads(data)
+		digests[None] = get_digest(data)
+		for table in obj.persist_tables:
+			self.ensure_table(table)
+			items = {}
+			for key, data in self.connection.execute("SELECT key, data FROM %s WHERE scope = ?" % table, (scope,)):
+				items[key] = load_state(data)
+			setattr(obj, table, items)
+		return obj
+
+	def save(self, scope, obj, digests):
+		"""Save an object as scope, in a single transaction. digests
+		is the dict of digests from load (or an empty dict for a new
+		object), and will be updated. Only the rows of the object's
+		tables that it's marked as modified are written."""
+
+		compression = self.persister.compression
+		with self.connection:
+			# Store the object without its tables.
+			tables = {}
+			for table in obj.persist_tables:
+				tables[table] = getattr(obj, table, {})
+				setattr(obj, table, {})
+			try:
+				data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+			finally:
+				for table, items in list(tables.items()):
+					setattr(obj, table, items)
+			# Compare the uncompressed data, since gzip includes
+			# the time in its output.
+			digest = get_digest(data)
+			if digests.get(None) != digest:
+				self.connection.execute("INSERT OR REPLACE INTO objects (scope, data) VALUES (?, ?)", (scope, COMPRESSORS[compression](data)))
+				digests[None] = digest
+
+			for table, items in list(tables.items()):
+				self.ensure_table(table)
+				keys = obj.get_modified_rows(table)
+				if keys is None:
+					# Any of the rows might have changed, so
+					# replace them all.
+					self.connection.execute("DELETE FROM %s WHERE scope = ?" % table, (scope,))
+					keys = list(items.keys())
+				changed = []
+				removed = []
+				for key in keys:
+					value = items.get(key)
+					if value is None and key not in items:
+						removed.append((scope, key))
+					else:
+						changed.append((scope, key, dump_state(value, compression)))
+				self.connection.executemany("INSERT OR REPLACE INTO %s (scope, key, data) VALUES (?, ?, ?)" % table, changed)
+				self.connection.executemany("DELETE FROM %s WHERE scope = ? AND key = ?" % table, removed)
+
+	def get_table_names(self):
+		return [row[0] for row in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'objects'")]
+
+	def rename(self, old_scope, new_scope):
+		with self.connection:
+			for table in ["objects"] + self.get_table_names():
+				self.connection.execute("UPDATE %s SET scope = ? WHERE scope = ?" % table, (new_scope, old_scope))
+
+	def delete(self, scope):
+		with self.connection:
+			for table in ["objects"] + self.get_table_names():
+				self.connection.execute("DELETE FROM %s WHERE scope = ?" % table, (scope,))
+
+class SQLitePersisted(Persisted):
+	"""As Persisted, but storing the object in a StateDatabase rather
+	than in its own file."""
+
+	def __init__(self, klass, filename, persister):
+		Persisted.__init__(self, klass, filename, persister)
+		self.database = persister.database
+		self.digests = {}
+
+	def location(self):
+		return os.path.abspath(self.database.filename) + " (" + self.filename + ")"
+
+	def rename(self, new_filename):
+		self.persister._rename(self.filename, new_filename)
+		self.database.open(False)
+		try:
+			self.database.rename(self.filename, new_filename)
+		finally:
+			self.database.close()
+		self.filename = new_filename
+
+	def _open(self, no_block):
+		self.persister.log("Loading state: ", self.filename)
+
+		if not self.database.open(no_block):
+			return None
+
+		self.digests = {}
+		self.object = self.database.load(self.filename, self.digests)
+		if self.object is None:
+			self.object = self.klass()
+			self.object.modified()
+		else:
+			self.object.modified(False)
+
+	def _save(self):
+		self.persister.log("Saving state: ", self.filename)
+		with rawdoglib.timing.phase("state_save"):
+			self.database.save(self.filename, self.object, self.digests)
+
+	def close(self):
+		self.refcount -= 1
+		if self.refcount > 0:
+			# Still in use.
+			return
+
+		if self.object.is_modified():
+			self._save()
+
+		self.database.close()
 		self.persister._remove(self.filename)
 
 class Persister:
@@ -160,6 +491,11 @@ class Persister:
 		self.files = {}
 		self.log = config.log
 		self.use_locking = config.locking
+		self.compression = config.get("statecompression", "none")
+		if config.get("statebackend") == "sqlite":
+			self.database = StateDatabase("state.db", "state", self)
+		else:
+			self.database = None
 
 	def get(self, klass, filename):
 		"""Get a context manager for a persisted file.
@@ -169,10 +505,20 @@ class Persister:
 		if filename in self.files:
 			return self.files[filename]
 
-		p = Persisted(klass, filename, self)
+		if self.database is not None:
+			p = SQLitePersisted(klass, filename, self)
+		else:
+			p = Persisted(klass, filename, self)
 		self.files[filename] = p
 		return p
 
+	def save(self, filename):
+		"""Save a persisted file that's currently open, without closing
+		it. Do nothing if it isn't open."""
+		p = self.files.get(filename)
+		if p is not None and p.refcount > 0:
+			p.save()
+
 	def _rename(self, old_filename, new_filename):
 		self.files[new_filename] = self.files[old_filename]
 		del self.files[old_filename]
@@ -183,6 +529,14 @@ class Persister:
 	def delete(self, filename):
 		"""Delete a persisted file, along with its lock file,
 		if they exist."""
+		if self.database is not None:
+			self.database.open(False)
+			try:
+				self.database.delete(filename)
+			finally:
+				self.database.close()
+			return
+
 		for ext in ("", ".lock"):
 			try:
 				os.unlink(filename + ext)
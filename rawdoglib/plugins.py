@@ -21,6 +21,8 @@
 import imp
 import os
 
+import rawdoglib.timing
+
 class Box:
 	"""Utility class that holds a mutable value. Useful for passing
 	immutable types by reference."""
@@ -28,6 +30,16 @@ class Box:
 		self.value = value
 
 plugin_count = 0
+# The files that plugins have been loaded from, mapped to their
+# modification times and module names, so that reloading the config only
+# loads a plugin again (replacing the hooks it attached) if it has changed.
+plugin_files = {}
+
+def detach_module_hooks(module_name):
+	"""Detach all the hook functions that were defined in a module."""
+	for hookname, funcs in attached.items():
+		funcs[:] = [func for func in funcs
+		            if getattr(func, "__module__", None) != module_name]
 
 def load_plugins(dir, config):
 	global plugin_count
@@ -50,11 +62,35 @@ def load_plugins(dir, config):
 			continue
 
 		fn = os.path.join(dir, file)
-		config.log("Loading plugin ", fn)
-		f = open(fn, "r")
-		imp.load_module("plugin%d" % (plugin_count,), f, fn, desc)
-		plugin_count += 1
-		f.close()
+		path = os.path.abspath(fn)
+		try:
+			mtime = os.stat(path).st_mtime
+		except OSError:
+			continue
+		old = plugin_files.get(path)
+		if old is not None:
+			if old[0] == mtime:
+				continue
+			config.log("Reloading plugin ", fn)
+			detach_module_hooks(old[1])
+		else:
+			config.log("Loading plugin ", fn)
+		module_name = "plugin%d" % (plugin_count,)
+		plugin_files[path] = (mtime, module_name)
+		with rawdoglib.timing.phase("plugins"):
+			f = open(fn, "r")
+			imp.load_module(module_name, f, fn, desc)
+			plugin_count += 1
+			f.close()
+
+# The extra fields of articles' entry_info that plugins want kept when
+# compactarticles is turned on.
+kept_article_fields = set()
+
+def keep_article_fields(*names):
+	"""Ask rawdog to keep the named fields of articles' entry_info
+	dicts (in full) when compactarticles is turned on."""
+	kept_article_fields.update(names)
 
 attached = {}
 
@@ -64,12 +100,21 @@ def attach_hook(hookname, func):
 	False to indicate whether further functions should be processed."""
 	attached.setdefault(hookname, []).append(func)
 
+def has_hook(hookname):
+	"""Return True if any functions are attached to a hook."""
+	return attached.get(hookname, []) != []
+
 def call_hook(hookname, *args):
 	"""Call all the functions attached to a hook with the given
 	arguments, in the order they were added, stopping if a hook function
 	returns False. Returns True if any hook function returned False (i.e.
 	returns True if any hook function handled the request)."""
+	timings = rawdoglib.timing.timings
 	for func in attached.get(hookname, []):
-		if not func(*args):
+		if timings is not None:
+			result = timings.call_hook_function(hookname, func, args)
+		else:
+			result = func(*args)
+		if not result:
 			return True
 	return False
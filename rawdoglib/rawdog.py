@@ -18,20 +18,35 @@ VERSION = "3.0"
 HTTP_AGENT = "rawdog/" + VERSION
 STATE_VERSION = 2
 
+import rawdoglib.asyncfetch
+import rawdoglib.connpool
 import rawdoglib.feedscanner
-from rawdoglib.persister import Persistable, Persister
-from rawdoglib.plugins import Box, call_hook, load_plugins
-
-from io import StringIO
+import rawdoglib.plugins
+import rawdoglib.timing
+from rawdoglib.articlestore import ArticleStore
+from rawdoglib.persister import COMPRESSORS, Persistable, Persister, dump_state, load_state_file
+from rawdoglib.plugins import Box, call_hook, has_hook, load_plugins
+
+from io import BytesIO, StringIO
+import asyncio
 import base64
+import bisect
 import calendar
 import cgi
+import collections
+import concurrent.futures
+import copyreg
+import email.utils
 import feedparser
 import getopt
 import hashlib
+import heapq
 import locale
+import multiprocessing
 import os
+import pickle
 import re
+import signal
 import socket
 import string
 import sys
@@ -41,6 +56,8 @@ import types
 import html as libhtml
 import urllib.request, urllib.error, urllib.parse
 import urllib.parse
+import xml.sax
+import xml.sax.xmlreader
 
 try:
 	import tidylib
@@ -65,6 +82,12 @@ except AttributeError:
 # This is initialised in main().
 persister = None
 
+# The SanitiseCache in use, if any. This is set while writing output.
+sanitise_cache = None
+
+# The IncrementalWriter in use, if any. This is set while writing output.
+incremental_writer = None
+
 system_encoding = None
 def get_system_encoding():
 	"""Get the system encoding."""
@@ -107,6 +130,13 @@ def sanitise_html(html, baseurl, inline, config):
 	if html is None:
 		return None
 
+	with rawdoglib.timing.phase("sanitise"):
+		if sanitise_cache is not None:
+			return sanitise_cache.sanitise(html, baseurl, inline, config)
+		return sanitise_html_uncached(html, baseurl, inline, config)
+
+def sanitise_html_uncached(html, baseurl, inline, config):
+	"""As sanitise_html, without using the cache."""
 	html = encode_references(html)
 	type = "text/html"
 
@@ -170,6 +200,86 @@ def sanitise_html(html, baseurl, inline, config):
 	call_hook("clean_html", config, box, baseurl, inline)
 	return box.value
 
+def get_hook_signature(hookname):
+	"""Return a string identifying the functions attached to a hook."""
+	sig = []
+	for func in rawdoglib.plugins.attached.get(hookname, []):
+		code = getattr(func, "__code__", None)
+		if code is None:
+			sig.append(repr(func))
+		else:
+			sig.append("%s:%s:%s" % (code.co_filename, func.__qualname__, hashlib.sha1(code.co_code).hexdigest()))
+	return ",".join(sig)
+
+def get_sanitise_signature(config):
+	"""Return a string identifying everything that might change the
+	output of sanitise_html, other than its arguments."""
+	return "\0".join([
+		VERSION,
+		getattr(feedparser, "__version__", ""),
+		str(config["blocklevelhtml"]),
+		str(config["tidyhtml"]),
+		str(tidylib is not None),
+		str(mxtidy is not None),
+		get_hook_signature("mxtidy_args"),
+		get_hook_signature("tidy_args"),
+		get_hook_signature("clean_html"),
+		])
+
+class SanitiseCache(Persistable):
+	"""A bounded cache of the results of sanitise_html, so that HTML that
+	hasn't changed since the last write doesn't need sanitising again.
+
+	entries maps a digest of sanitise_html's arguments to a list of
+	[result, generation], where generation is the number of the last
+	write that used the entry; when the cache is full, the entries that
+	were used least recently are discarded."""
+
+	persist_tables = ("entries",)
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.entries = {}
+		self.generation = 0
+		self.signature = ""
+
+	def start(self, config):
+		"""Prepare to use the cache for a write."""
+		self.generation += 1
+		self.hits = 0
+		self.misses = 0
+		self.signature = get_sanitise_signature(config)
+
+	def sanitise(self, html, baseurl, inline, config):
+		"""As sanitise_html, but using the cache."""
+		key = hashlib.sha1("\0".join([self.signature, baseurl or "", str(inline), html]).encode("UTF-8", "surrogatepass")).hexdigest()
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			entry = [sanitise_html_uncached(html, baseurl, inline, config), self.generation]
+			self.entries[key] = entry
+			self.row_modified("entries", key)
+		else:
+			self.hits += 1
+			if entry[1] != self.generation:
+				# The cache must be saved even if nothing else
+				# changes, or entries that are still in use
+				# would look stale next time it's trimmed.
+				entry[1] = self.generation
+				self.row_modified("entries", key)
+		return entry[0]
+
+	def trim(self, size):
+		"""Discard the least recently used entries so that the cache
+		contains at most size entries."""
+		excess = len(self.entries) - size
+		if excess <= 0:
+			return
+		keys = sorted(self.entries.keys(), key=lambda k: self.entries[k][1])
+		for key in keys[:excess]:
+			del self.entries[key]
+			self.row_modified("entries", key)
+
 def select_detail(details):
 	"""Pick the preferred type of detail from a list of details. (If the
 	argument isn't a list, treat it as a list of one.)"""
@@ -255,45 +365,150 @@ def string_to_html(s, config):
 	return sanitise_html(libhtml.escape(s), "", True, config)
 
 template_re = re.compile(r'(__[^_].*?__)')
-def fill_template(template, bits):
+
+# Operations in a compiled template.
+TEMPLATE_TEXT, TEMPLATE_BIT, TEMPLATE_IF, TEMPLATE_JUMP = list(range(4))
+
+class CompiledTemplate:
+	"""A template compiled into a list of operations, so that it can be
+	expanded many times without parsing it again.
+
+	Each operation is a tuple (op, arg, target). TEMPLATE_TEXT writes the
+	string arg; TEMPLATE_BIT writes bits[arg] if it exists;
+	TEMPLATE_IF continues if bits[arg] is not "", else jumps to
+	operation target; TEMPLATE_JUMP jumps to operation target.
+
+	The jumps are worked out from the nesting of __if_x__, __else__ and
+	__endif__, which doesn't depend on the bits. An __if_x__ jumps past
+	its first __else__ (or its __endif__) if false; each __else__ jumps
+	past the next __else__ or __endif__ in the same section, since the
+	section after it is only written if the one before wasn't. Stray
+	__else__s and __endif__s are ignored, and unclosed sections run to
+	the end of the template."""
+
+	def __init__(self, template):
+		self.ops = []
+		# For each open __if_x__, the indexes of the operations
+		# whose target should be the next __else__ or __endif__.
+		open_ifs = []
+
+		def set_targets(indexes):
+			for i in indexes:
+				(op, arg, target) = self.ops[i]
+				self.ops[i] = (op, arg, len(self.ops))
+
+		for part in template_re.split(str(template)):
+			if part.startswith("__") and part.endswith("__"):
+				key = part[2:-2]
+				if key.startswith("if_"):
+					open_ifs.append([len(self.ops)])
+					self.ops.append((TEMPLATE_IF, key[3:], None))
+				elif key == "endif":
+					if open_ifs != []:
+						set_targets(open_ifs.pop())
+				elif key == "else":
+					if open_ifs != []:
+						jump = len(self.ops)
+						self.ops.append((TEMPLATE_JUMP, None, None))
+						set_targets(open_ifs[-1])
+						open_ifs[-1] = [jump]
+				else:
+					self.ops.append((TEMPLATE_BIT, key, None))
+			elif part != "":
+				self.ops.append((TEMPLATE_TEXT, part, None))
+
+		for indexes in open_ifs:
+			set_targets(indexes)
+
+	def names(self):
+		"""Return the set of bit names that the template uses."""
+		return set([arg for (op, arg, target) in self.ops
+		            if op in (TEMPLATE_BIT, TEMPLATE_IF)])
+
+	def fill(self, bits):
+		"""Expand the template with the given bits."""
+		ops = self.ops
+		num_ops = len(ops)
+		out = []
+		i = 0
+		while i < num_ops:
+			(op, arg, target) = ops[i]
+			if op == TEMPLATE_TEXT:
+				out.append(arg)
+			elif op == TEMPLATE_BIT:
+				if arg in bits:
+					out.append(str(bits[arg]))
+			elif op == TEMPLATE_IF:
+				if not (arg in bits and bits[arg] != ""):
+					i = target
+					continue
+			else:
+				i = target
+				continue
+			i += 1
+		return "".join(out)
+
+# The maximum number of compiled templates to keep.
+MAX_COMPILED_TEMPLATES = 100
+
+# Compiled templates for template text that didn't come from a config
+# (the parts of a split page template, or templates that plugins expand
+# themselves), so it's never out of date. The config's own templates
+# are compiled by Rawdog.get_compiled_template.
+compiled_templates = {}
+def compile_template(template):
+	"""Return a CompiledTemplate for template, reusing a previously-
+	compiled one if possible."""
+	compiled = compiled_templates.get(template)
+	if compiled is None:
+		if len(compiled_templates) >= MAX_COMPILED_TEMPLATES:
+			compiled_templates.clear()
+		compiled = CompiledTemplate(template)
+		compiled_templates[template] = compiled
+	return compiled
+
+def fill_template(template, bits, compiled=None):
 	"""Expand a template, replacing __x__ with bits["x"], and only
 	including sections bracketed by __if_x__ .. [__else__ ..]
 	__endif__ if bits["x"] is not "". If not bits.has_key("x"),
-	__x__ expands to ""."""
-	result = Box()
-	call_hook("fill_template", template, bits, result)
-	if result.value is not None:
-		return result.value
-
-	#encoding = get_system_encoding()
-
-	f = StringIO()
-	if_stack = []
-	def write(s):
-		if not False in if_stack:
-			f.write(str(s))
-	for part in template_re.split(str(template)):
+	__x__ expands to "". If compiled is given, it's the template's
+	CompiledTemplate."""
+	with rawdoglib.timing.phase("template"):
+		result = Box()
+		call_hook("fill_template", template, bits, result)
+		if result.value is not None:
+			return result.value
+
+		if compiled is None:
+			compiled = compile_template(template)
+		return compiled.fill(bits)
+
+def split_template(template, key):
+	"""If __key__ appears exactly once in template, outside any
+	conditional section, and the template doesn't otherwise depend on
+	bits["key"], return a tuple of the parts of the template before and
+	after it. Otherwise, return None. Expanding the two parts separately
+	gives the same result as expanding the whole template."""
+	parts = template_re.split(str(template))
+	depth = 0
+	pos = None
+	for i, part in enumerate(parts):
 		if part.startswith("__") and part.endswith("__"):
-			key = part[2:-2]
-			if key.startswith("if_"):
-				k = key[3:]
-				if_stack.append(k in bits and bits[k] != "")
-			elif key == "endif":
-				if if_stack != []:
-					if_stack.pop()
-			elif key == "else":
-				if if_stack != []:
-					if_stack.append(not if_stack.pop())
-			elif key in bits:
-				#if type(bits[key]) == str:
-					#write(bits[key].encode(encoding))
-				#else:
-				write(bits[key])
-		else:
-			write(part)
-	v = f.getvalue()
-	f.close()
-	return v
+			k = part[2:-2]
+			if k.startswith("if_"):
+				if k[3:] == key:
+					return None
+				depth += 1
+			elif k == "endif":
+				if depth > 0:
+					depth -= 1
+			elif k == key:
+				if depth > 0 or pos is not None:
+					return None
+				pos = i
+	if pos is None:
+		return None
+	return ("".join(parts[:pos]), "".join(parts[pos + 1:]))
 
 file_cache = {}
 def load_file(name):
@@ -327,6 +542,14 @@ def short_hash(s):
 	"""Return a human-manipulatable 'short hash' of a string."""
 	return hashlib.sha1(bytes(s,"UTF-8")).hexdigest()[-8:]
 
+# Hash functions that can be used to compute article hashes. They all
+# produce 20-byte digests, so the hashes are the same length whichever
+# is used.
+HASH_SCHEMES = {
+	"sha1": hashlib.sha1,
+	"blake2b": lambda: hashlib.blake2b(digest_size=20),
+	}
+
 def ensure_unicode(value, encoding):
 	"""Convert a structure returned by feedparser into an equivalent where
 	all strings are represented as fully-decoded unicode objects."""
@@ -347,6 +570,11 @@ def ensure_unicode(value, encoding):
 	elif isinstance(value, dict):
 		d = {}
 		for (k, v) in list(value.items()):
+			if isinstance(k, str):
+				# The same keys appear in every entry, so
+				# interning them means that pickled state only
+				# needs to store each one once.
+				k = sys.intern(k)
 			d[k] = ensure_unicode(v, encoding)
 		return d
 	elif isinstance(value, list):
@@ -427,6 +655,9 @@ class ResponseLogProcessor(urllib.request.BaseHandler):
 		location = response.info().get("Location")
 		if location is not None:
 			entry["location"] = location
+		retry_after = response.info().get("Retry-After")
+		if retry_after is not None:
+			entry["retry_after"] = retry_after
 		self.log.append(entry)
 		return response
 
@@ -435,6 +666,290 @@ class ResponseLogProcessor(urllib.request.BaseHandler):
 	def get_log(self):
 		return self.log
 
+def is_request_handler(handler):
+	"""Return True if a urllib2 handler only modifies outgoing requests
+	(so it can be used without urllib2 actually making the request), or
+	False if it needs to open URLs or process responses itself."""
+	for name in dir(handler):
+		if (name.endswith("_open") or name.endswith("_response")
+		    or name.startswith("http_error_")):
+			return False
+	return True
+
+def get_feedparser_args():
+	"""Return the extra arguments that rawdog passes to feedparser.parse.
+	(Older versions of feedparser are configured globally instead.)"""
+	# Turn off content-cleaning, as we need the original content
+	# for hashing and we'll do this ourselves afterwards.
+	if hasattr(feedparser, "api"):
+		# feedparser > 5.2
+		return {
+			"sanitize_html": False,
+			"resolve_relative_uris": False,
+			}
+	else:
+		# feedparser <= 5.2
+		feedparser.RESOLVE_RELATIVE_URIS = 0
+		feedparser.SANITIZE_HTML = 0
+		# Microformat support (removed in version 6) tends to return
+		# poor-quality data, and relies on BeautifulSoup which
+		# is unable to parse many feeds.
+		feedparser.PARSE_MICROFORMATS = 0
+		return {}
+
+def get_base_uri(href, contentloc):
+	"""Work out the base URI for a feed's content in the same way that
+	feedparser does when it fetches the feed itself."""
+	try:
+		safe_uri = feedparser.urls.make_safe_absolute_uri
+	except AttributeError:
+		return urllib.parse.urljoin(href, contentloc)
+	return safe_uri(href, contentloc) or safe_uri(contentloc) or href
+
+def get_response_download(response):
+	"""Convert a rawdoglib.asyncfetch.Response into a download dict for
+	parse_download, with the same metadata feedparser would have
+	collected had it fetched the feed itself."""
+	headers = response.headers
+	info = {
+		"headers": headers,
+		"href": response.url,
+		# feedparser reports the status of the first redirect.
+		"status": response.history[0]["status"],
+		}
+	if headers.get("etag"):
+		info["etag"] = headers["etag"]
+	if headers.get("last-modified"):
+		info["modified"] = headers["last-modified"]
+	if response.status == 304:
+		info["version"] = ""
+	return {
+		"rawdog_data": response.data,
+		"rawdog_info": info,
+		"rawdog_responses": response.history,
+		}
+
+def parse_download(download):
+	"""Parse a downloaded feed, returning the same dict that
+	feedparser.parse would have returned if it had fetched the feed
+	itself.
+
+	download is a dict containing the raw data as "rawdog_data", and
+	feedparser's HTTP metadata (headers, href, status and so on) as
+	"rawdog_info"; any other "rawdog_" keys are copied into the result.
+	If it doesn't contain "rawdog_data", then the download failed, and
+	the dict is returned unchanged."""
+
+	if "rawdog_data" not in download:
+		return download
+
+	info = download["rawdog_info"]
+	result = feedparser.FeedParserDict(
+		bozo=False,
+		entries=[],
+		feed=feedparser.FeedParserDict(),
+		headers={},
+		)
+	result.update(info)
+
+	data = download["rawdog_data"]
+	if data:
+		# feedparser doesn't know where the data came from, so tell it
+		# the base URI it would have used.
+		headers = dict(info.get("headers", {}))
+		headers["content-location"] = get_base_uri(info.get("href", ""), headers.get("content-location", ""))
+		parsed = feedparser.parse(BytesIO(data), response_headers=headers, **get_feedparser_args())
+		for key, value in list(parsed.items()):
+			if key == "headers" or (key == "bozo" and not value):
+				continue
+			result[key] = value
+
+	for key, value in list(download.items()):
+		if key not in ("rawdog_data", "rawdog_info"):
+			result[key] = value
+	return result
+
+def parse_fetched(download):
+	"""Parse the result of Feed.download, returning the same result that
+	Feed.fetch would have returned."""
+	try:
+		result = parse_download(download)
+	except Exception as e:
+		result = get_exception_result(e)
+		result["rawdog_responses"] = download.get("rawdog_responses", [])
+	return finish_fetch_result(result)
+
+def parse_fetched_in_process(download):
+	"""As parse_fetched, but called in a worker process, so the result
+	must be picklable. The time taken to parse it is returned in the
+	result as rawdog_parse_time."""
+	start_wall = time.perf_counter()
+	start_cpu = time.process_time()
+	result = parse_fetched(download)
+	result["rawdog_parse_time"] = (time.perf_counter() - start_wall, time.process_time() - start_cpu)
+	if "rawdog_traceback" in result:
+		from traceback import format_tb
+		result["rawdog_traceback"] = "".join(format_tb(result["rawdog_traceback"]))
+	return result
+
+def check_unchanged_body(feed, download, config):
+	"""If "skipunchanged" is on, add a digest of a successful download's
+	data to it as rawdog_body_digest. If the data is the same as it was
+	when the feed was last updated, remove it so that it won't be parsed,
+	and mark the download as rawdog_unchanged instead."""
+	data = download.get("rawdog_data")
+	if not config["skipunchanged"] or data is None:
+		return
+	responses = download.get("rawdog_responses")
+	if responses and responses[-1]["status"] != 200:
+		return
+
+	h = HASH_SCHEMES[config["hashscheme"]]()
+	h.update(data)
+	digest = h.hexdigest()
+	# States from older versions of rawdog don't have this.
+	if digest == getattr(feed, "body_digest", None):
+		del download["rawdog_data"]
+		del download["rawdog_info"]
+		download["rawdog_unchanged"] = True
+	else:
+		download["rawdog_body_digest"] = digest
+
+def get_download_stats(download, fetch_time):
+	"""Return the statistics to record about a download that took
+	fetch_time seconds. The time taken to parse it is added later."""
+	data = download.get("rawdog_data")
+	if data is None:
+		size = 0
+	else:
+		size = len(data)
+	return {
+		"fetch_time": fetch_time,
+		"bytes": size,
+		"parse_time": 0.0,
+		}
+
+class SAXLocator(xml.sax.xmlreader.Locator):
+	"""A fixed position in a document."""
+
+	def __init__(self, public_id, system_id, line, column):
+		self.public_id = public_id
+		self.system_id = system_id
+		self.line = line
+		self.column = column
+
+	def getColumnNumber(self):
+		return self.column
+
+	def getLineNumber(self):
+		return self.line
+
+	def getPublicId(self):
+		return self.public_id
+
+	def getSystemId(self):
+		return self.system_id
+
+def make_sax_parse_exception(msg, exception, public_id, system_id, line, column):
+	return xml.sax.SAXParseException(msg, exception, SAXLocator(public_id, system_id, line, column))
+
+def reduce_sax_parse_exception(e):
+	return (make_sax_parse_exception, (e.getMessage(), e.getException(), e.getPublicId(), e.getSystemId(), e.getLineNumber(), e.getColumnNumber()))
+
+# feedparser returns SAXParseExceptions in bozo_exception for malformed
+# feeds. They keep a reference to the parser, so they can't normally be
+# pickled -- which we need to be able to do to return them from a parser
+# process.
+copyreg.pickle(xml.sax.SAXParseException, reduce_sax_parse_exception)
+
+def get_exception_result(e):
+	"""Return the fetch result for an exception raised while fetching a
+	feed. This must be called from the exception handler."""
+	if is_timeout_exception(e):
+		return {"rawdog_timeout": e}
+	else:
+		return {
+			"rawdog_exception": e,
+			"rawdog_traceback": sys.exc_info()[2],
+			}
+
+def finish_fetch_result(result):
+	"""Tidy up the result of fetching a feed before returning it."""
+	# For compatibility with old hooks, include an empty "feed"
+	# if a timeout occurred.
+	if "rawdog_timeout" in result:
+		result["feed"] = []
+	return result
+
+def parse_http_date(value):
+	"""Parse an HTTP date, returning a time in seconds since the epoch,
+	or None if it can't be parsed."""
+	parsed = email.utils.parsedate_tz(value)
+	if parsed is None:
+		return None
+	return email.utils.mktime_tz(parsed)
+
+def get_cache_delay(headers, now):
+	"""Return the number of seconds that a set of HTTP response headers
+	(with lowercase names) asks the client to wait before fetching the
+	resource again, or None if they don't say."""
+	delays = []
+
+	# Cache-Control's max-age overrides Expires.
+	max_age = None
+	for directive in headers.get("cache-control", "").split(","):
+		(name, _, value) = directive.strip().partition("=")
+		if name.lower() == "max-age":
+			try:
+				max_age = int(value.strip('"'))
+			except ValueError:
+				pass
+	if max_age is not None:
+		delays.append(max_age)
+	elif "expires" in headers:
+		expires = parse_http_date(headers["expires"])
+		# Use the server's idea of the current time if we have it.
+		date = parse_http_date(headers.get("date", ""))
+		if date is None:
+			date = now
+		if expires is not None:
+			delays.append(expires - date)
+
+	retry_after = headers.get("retry-after")
+	if retry_after is not None:
+		retry_after = retry_after.strip()
+		if retry_after.isdigit():
+			delays.append(int(retry_after))
+		else:
+			when = parse_http_date(retry_after)
+			if when is not None:
+				delays.append(when - now)
+
+	if delays == []:
+		return None
+	return max(0, max(delays))
+
+# Response codes with which a server may ask us to slow down.
+BACK_OFF_CODES = (429, 503)
+
+def get_retry_delay(responses, now):
+	"""Return the number of seconds that the final response in a
+	download's response log asked the client to wait before trying
+	again, or None if it wasn't asking the client to back off."""
+	if not responses:
+		return None
+	last = responses[-1]
+	if last["status"] not in BACK_OFF_CODES or "retry_after" not in last:
+		return None
+	return get_cache_delay({"retry-after": last["retry_after"]}, now)
+
+# The statistics kept for each feed: the number of times it's been
+# fetched, how many of those returned 304 Not Modified, returned content
+# with no new articles, or failed, the number of bytes of feed data
+# received, and the total time spent fetching and parsing it.
+FEED_STATS = ("fetches", "not_modified", "unchanged", "errors", "bytes",
+              "fetch_time", "parse_time")
+
 non_alphanumeric_re = re.compile(r'<[^>]*>|\&[^\;]*\;|[^a-z0-9]')
 class Feed:
 	"""An RSS feed."""
@@ -445,19 +960,156 @@ class Feed:
 		self.args = {}
 		self.etag = None
 		self.modified = None
+		self.body_digest = None
 		self.last_update = 0
+		self.next_update = None
+		self.update_history = []
+		self.stats = dict.fromkeys(FEED_STATS, 0)
 		self.feed_info = {}
+		self.article_summary = None
 
-	def needs_update(self, now):
+	def needs_update(self, now, config=None):
 		"""Return True if it's time to update this feed, or False if
 		its update period has not yet elapsed."""
-		return (now - self.last_update) >= self.period
+		return now >= self.get_next_update(config)
+
+	def get_next_update(self, config=None):
+		"""Return the time at which this feed should next be
+		updated."""
+		next_update = getattr(self, "next_update", None)
+		if not (config is not None and config["adaptiveperiod"] and next_update is not None):
+			next_update = self.last_update + self.period
+			if config is not None and config["spreadfeeds"] and self.period > 0:
+				# Bring the update forward to the last time at
+				# the feed's phase within its period. Once a
+				# feed's been updated at its phase, it'll then be
+				# updated every period.
+				next_update -= (next_update - self.get_phase()) % self.period
+
+		# States from older versions of rawdog don't have this.
+		retry_after = getattr(self, "retry_after", None)
+		if retry_after is not None:
+			next_update = max(next_update, retry_after)
+		return next_update
+
+	def get_phase(self):
+		"""Return this feed's offset within its period, so that feeds
+		with the same period don't all need updating at once. It
+		depends only on the feed's URL, so it stays the same between
+		runs."""
+		return (int(self.get_short_hash(), 16) * self.period) // 0x100000000
+
+	def record_update(self, now, changed):
+		"""Remember whether the feed had changed when it was updated,
+		for the adaptive scheduler."""
+		history = getattr(self, "update_history", [])
+		history.append((now, changed))
+		# Only the recent history is useful.
+		self.update_history = history[-10:]
+
+	def get_stats(self):
+		"""Return the dict of statistics about fetching this feed."""
+		# States from older versions of rawdog don't have this.
+		stats = getattr(self, "stats", None)
+		if stats is None:
+			stats = dict.fromkeys(FEED_STATS, 0)
+			self.stats = stats
+		return stats
+
+	def describe_stats(self):
+		"""Return a dict of strings describing this feed's statistics,
+		with the times averaged over the number of fetches."""
+		stats = self.get_stats()
+		fetches = stats["fetches"]
+		def percent(count):
+			if fetches == 0:
+				return "0%"
+			return "%d%%" % (100 * count // fetches)
+		def average(total):
+			if fetches == 0:
+				return "0.000"
+			return "%.3f" % (total / fetches)
+		return {
+			"fetches": str(fetches),
+			"not_modified": str(stats["not_modified"]),
+			"not_modified_percent": percent(stats["not_modified"]),
+			"unchanged": str(stats["unchanged"]),
+			"unchanged_percent": percent(stats["unchanged"]),
+			"errors": str(stats["errors"]),
+			"bytes": str(stats["bytes"]),
+			"fetch_time": average(stats["fetch_time"]),
+			"parse_time": average(stats["parse_time"]),
+			}
+
+	def get_adaptive_period(self, config):
+		"""Estimate how long to wait before updating this feed again
+		from how often it has changed recently, within the bounds
+		given by the config. The feed's own period is always allowed,
+		and is used until there's enough history to go on."""
+		lower = min(config["minperiod"], self.period)
+		upper = max(config["maxperiod"], self.period)
+
+		history = getattr(self, "update_history", [])
+		if len(history) < 2:
+			return self.period
+
+		changes = len([1 for (when, changed) in history[1:] if changed])
+		if changes == 0:
+			# Nothing has changed recently. Back off.
+			period = 2 * (history[-1][0] - history[-2][0])
+		else:
+			# Check twice as often as it has been changing, so
+			# that new articles are seen promptly.
+			period = (history[-1][0] - history[0][0]) / (2 * changes)
+		return min(upper, max(lower, period))
+
+	def schedule_update(self, now, config, p):
+		"""Work out when this feed should next be updated, given the
+		result of fetching it."""
+		# If the server asked us to back off, don't try again until
+		# it said we could, whatever the period is.
+		delay = get_retry_delay(p.get("rawdog_responses"), now)
+		if delay is not None:
+			delay = min(delay, max(config["maxperiod"], self.period))
+			self.retry_after = now + delay
+			config.log("Server asked for ", self.url, " not to be fetched for ", int(delay), " seconds")
+		else:
+			self.retry_after = None
+
+		if not config["adaptiveperiod"]:
+			self.next_update = None
+			return
+
+		period = self.get_adaptive_period(config)
+		next_update = self.last_update + period
+
+		# The server may have asked us not to come back for a
+		# while.
+		delay = get_cache_delay(p.get("headers", {}), now)
+		if delay is not None:
+			delay = min(delay, max(config["maxperiod"], self.period))
+			next_update = max(next_update, now + delay)
+
+		self.next_update = next_update
+		config.log("Next update of ", self.url, " in ", int(next_update - now), " seconds")
+
+	def get_short_hash(self):
+		"""Return the short hash of this feed's URL. This is needed
+		whenever the feed's state is loaded or its articles are
+		written, so it's cached."""
+		# States from older versions of rawdog don't have this.
+		cached = getattr(self, "short_hash", None)
+		if cached is None or cached[0] != self.url:
+			cached = (self.url, short_hash(self.url))
+			self.short_hash = cached
+		return cached[1]
 
 	def get_state_filename(self):
-		return "feeds/%s.state" % (short_hash(self.url),)
+		return "feeds/%s.state" % (self.get_short_hash(),)
 
-	def fetch(self, rawdog, config):
-		"""Fetch the current set of articles from the feed."""
+	def get_handlers(self, rawdog, config):
+		"""Return the list of urllib2 handlers to use when fetching
+		this feed, and the ResponseLogProcessor amongst them."""
 
 		handlers = []
 
@@ -486,36 +1138,77 @@ class Feed:
 
 		call_hook("add_urllib2_handlers", rawdog, config, self, handlers)
 
+		return (handlers, logger)
+
+	def get_fetch_url(self):
+		"""Return the URL to fetch the feed from."""
 		url = self.url
 		# Turn plain filenames into file: URLs. (feedparser will open
 		# plain filenames itself, but we want it to open the file with
 		# urllib2 so we get a URLError if something goes wrong.)
 		if not ":" in url:
 			url = "file:" + url
+		return url
+
+	def fetch(self, rawdog, config):
+		"""Fetch the current set of articles from the feed."""
+		return parse_fetched(self.download(rawdog, config))
+
+	def download(self, rawdog, config, pool=None):
+		"""Download the feed, without parsing it. The result should be
+		passed to parse_fetched. pool is a
+		rawdoglib.connpool.ConnectionPool to use for HTTP connections,
+		or None."""
+		(handlers, logger) = self.get_handlers(rawdog, config)
+		return self.download_urllib(handlers, logger, pool)
+
+	def download_urllib(self, handlers, logger, pool=None):
+		"""Download the feed using feedparser's urllib2-based
+		downloader, with the given set of handlers."""
 
-		parse_args = {
+		if pool is not None:
+			handlers = handlers + pool.get_handlers(handlers)
+
+		try:
+			get = feedparser.http.get
+		except AttributeError:
+			# feedparser before 6 can't download without parsing.
+			return self.fetch_urllib(handlers, logger)
+
+		info = {}
+		try:
+			data = get(self.get_fetch_url(), self.etag, self.modified, HTTP_AGENT, None, handlers, None, info)
+			result = {
+				"rawdog_data": data,
+				"rawdog_info": info,
+				}
+		except urllib.error.URLError as e:
+			# feedparser.parse would have returned this in
+			# bozo_exception.
+			if is_timeout_exception(e):
+				result = {"rawdog_timeout": e}
+			else:
+				result = {"rawdog_exception": e}
+		except Exception as e:
+			result = get_exception_result(e)
+		result["rawdog_responses"] = logger.get_log()
+
+		return finish_fetch_result(result)
+
+	def fetch_urllib(self, handlers, logger):
+		"""Fetch the feed using feedparser's urllib2-based downloader,
+		with the given set of handlers."""
+
+		parse_args = get_feedparser_args()
+		parse_args.update({
 			"etag": self.etag,
 			"modified": self.modified,
 			"agent": HTTP_AGENT,
 			"handlers": handlers,
-			}
-		# Turn off content-cleaning, as we need the original content
-		# for hashing and we'll do this ourselves afterwards.
-		if hasattr(feedparser, "api"):
-			# feedparser > 5.2
-			parse_args["sanitize_html"] = False
-			parse_args["resolve_relative_uris"] = False
-		else:
-			# feedparser <= 5.2
-			feedparser.RESOLVE_RELATIVE_URIS = 0
-			feedparser.SANITIZE_HTML = 0
-			# Microformat support (removed in version 6) tends to return
-			# poor-quality data, and relies on BeautifulSoup which
-			# is unable to parse many feeds.
-			feedparser.PARSE_MICROFORMATS = 0
+			})
 
 		try:
-			result = feedparser.parse(url, **parse_args)
+			result = feedparser.parse(self.get_fetch_url(), **parse_args)
 
 			# Older versions of feedparser return some kinds of
 			# download errors in bozo_exception rather than raising
@@ -526,25 +1219,68 @@ class Feed:
 			elif isinstance(e, urllib.error.URLError):
 				result = {"rawdog_exception": e}
 		except Exception as e:
-			if is_timeout_exception(e):
-				result = {"rawdog_timeout": e}
-			else:
-				result = {
-					"rawdog_exception": e,
-					"rawdog_traceback": sys.exc_info()[2],
-					}
+			result = get_exception_result(e)
 		result["rawdog_responses"] = logger.get_log()
 
-		# For compatibility with old hooks, include an empty "feed"
-		# if a timeout occurred.
-		if "rawdog_timeout" in result:
-			result["feed"] = []
+		return finish_fetch_result(result)
+
+	def make_request(self, url, handlers):
+		"""Build a urllib2 Request for the feed with the same headers
+		that feedparser would send, then let the handlers modify it."""
+		req = urllib.request.Request(url)
+		req.add_header("User-Agent", HTTP_AGENT)
+		if self.etag:
+			req.add_header("If-None-Match", self.etag)
+		if isinstance(self.modified, str):
+			req.add_header("If-Modified-Since", self.modified)
+		req.add_header("Accept-encoding", "gzip, deflate")
+		try:
+			accept = feedparser.http.ACCEPT_HEADER
+		except AttributeError:
+			accept = getattr(feedparser, "ACCEPT_HEADER", None)
+		if accept:
+			req.add_header("Accept", accept)
+		req.add_header("A-IM", "feed")
+
+		method = req.type + "_request"
+		for handler in sorted(handlers, key=lambda h: h.handler_order):
+			if hasattr(handler, method):
+				req = getattr(handler, method)(req)
+		return req
 
-		return result
+	async def download_async(self, rawdog, config, limiter, pool=None, async_pool=None, executor=None):
+		"""As download, but using asyncio without blocking the event
+		loop. limiter is the rawdoglib.asyncfetch.HostLimiter for this
+		set of fetches. async_pool is the
+		rawdoglib.asyncfetch.ConnectionPool to use, or None; pool is
+		used if the feed needs fetching with urllib2, in a thread from
+		executor (or the loop's default executor if it's None)."""
+
+		(handlers, logger) = self.get_handlers(rawdog, config)
+		url = self.get_fetch_url()
+
+		others = [h for h in handlers if h is not logger]
+		if not (rawdoglib.asyncfetch.can_fetch(url)
+		        and all(is_request_handler(h) for h in others)):
+			# This needs urllib2 -- so fetch it in a thread instead.
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(executor, self.download_urllib, handlers, logger, pool)
+
+		req = self.make_request(url, others)
+		try:
+			response = await rawdoglib.asyncfetch.fetch(url, req.header_items(), config["timeout"], limiter, async_pool)
+			result = get_response_download(response)
+		except Exception as e:
+			result = get_exception_result(e)
+			result["rawdog_responses"] = []
 
-	def update(self, rawdog, now, config, articles, p):
+		return finish_fetch_result(result)
+
+	def update(self, rawdog, now, config, articles, p, index=None):
 		"""Add new articles from a feed to the collection.
-		Returns True if any articles were read, False otherwise."""
+		Returns True if any articles were read, False otherwise.
+		If index is not None, it is the ArticleIndex for articles, and
+		will be kept up to date."""
 
 		# Note that feedparser might have thrown an exception --
 		# so until we print the error message and return, we
@@ -565,6 +1301,13 @@ class Feed:
 		if version is None:
 			version = ""
 
+		stats = self.get_stats()
+		stats["fetches"] += 1
+		download_stats = p.get("rawdog_stats")
+		if download_stats is not None:
+			for key in ("bytes", "fetch_time", "parse_time"):
+				stats[key] += download_stats[key]
+
 		self.last_update = now
 
 		errors = []
@@ -606,6 +1349,7 @@ class Feed:
 
 		if "rawdog_timeout" in p:
 			if config["ignoretimeouts"]:
+				stats["errors"] += 1
 				return False
 			else:
 				errors.append("Timeout while reading feed.")
@@ -615,13 +1359,26 @@ class Feed:
 			errors.append("Error fetching or parsing feed:")
 			errors.append(str(p["rawdog_exception"]))
 			if config["showtracebacks"] and "rawdog_traceback" in p:
-				from traceback import format_tb
-				errors.append("".join(format_tb(p["rawdog_traceback"])))
+				tb = p["rawdog_traceback"]
+				if not isinstance(tb, str):
+					# Not already formatted by a parser process.
+					from traceback import format_tb
+					tb = "".join(format_tb(tb))
+				errors.append(tb)
 			errors.append("")
 			fatal = True
 		elif last_status == 304:
 			# The feed hasn't changed. Return False to indicate
 			# that we shouldn't do expiry.
+			stats["not_modified"] += 1
+			self.record_update(now, False)
+			return False
+		elif "rawdog_unchanged" in p:
+			# The server sent exactly what it sent last time,
+			# ignoring our conditional request. Handle it the same
+			# way as a 304.
+			stats["unchanged"] += 1
+			self.record_update(now, False)
 			return False
 		elif last_status in [403, 410]:
 			# The feed is disallowed or gone. The feed should be
@@ -655,6 +1412,7 @@ class Feed:
 			for line in errors:
 				print(line, file=sys.stderr)
 			if fatal:
+				stats["errors"] += 1
 				return False
 
 		# From here, we can assume that we've got a complete feedparser
@@ -665,53 +1423,102 @@ class Feed:
 		# No entries means the feed hasn't changed, but for some reason
 		# we didn't get a 304 response. Handle it the same way.
 		if len(p["entries"]) == 0:
+			stats["unchanged"] += 1
+			self.record_update(now, False)
 			return False
 
 		self.etag = p.get("etag")
 		self.modified = p.get("modified")
+		self.body_digest = p.get("rawdog_body_digest")
 
 		self.feed_info = p["feed"]
 		feed = self.url
 
-		article_ids = {}
-		if config["useids"]:
+		article_ids = None
+		if config["useids"] and index is None:
 			# Find IDs for existing articles.
+			article_ids = {}
 			for (hash, a) in list(articles.items()):
 				id = a.entry_info.get("id")
 				if a.feed == feed and id is not None:
 					article_ids[id] = a
 
+		# If the hash scheme has changed since this feed's articles were
+		# stored, each existing article is moved to its new hash when
+		# it's next seen. (States from older versions of rawdog don't
+		# have this, and used SHA-1.)
+		hash_scheme = config["hashscheme"]
+		old_scheme = getattr(self, "hash_scheme", "sha1")
+
 		seen_articles = set()
+		added_articles = set()
 		sequence = 0
 		for entry_info in p["entries"]:
-			article = Article(feed, entry_info, now, sequence)
+			article = Article(feed, entry_info, now, sequence, hash_scheme)
+			old_hash = None
+			if old_scheme != hash_scheme:
+				old_hash = article.compute_initial_hash(old_scheme)
 			ignore = Box(False)
 			call_hook("article_seen", rawdog, config, article, ignore)
 			if ignore.value:
 				continue
+			if config["compactarticles"]:
+				article.compact()
 			seen_articles.add(article.hash)
 			sequence += 1
 
 			id = entry_info.get("id")
-			if id in article_ids:
-				existing_article = article_ids[id]
-			elif article.hash in articles:
-				existing_article = articles[article.hash]
+			existing_article = None
+			if not config["useids"] or id is None:
+				pass
+			elif article_ids is not None:
+				existing_article = article_ids.get(id)
 			else:
-				existing_article = None
+				existing_article = index.find_id(feed, id, articles)
+				if existing_article is not None and existing_article.hash in added_articles:
+					# Only match articles that existed before
+					# this update.
+					existing_article = None
+			if existing_article is None:
+				existing_article = articles.get(article.hash)
+			if existing_article is None and old_hash is not None:
+				existing_article = articles.get(old_hash)
+				if existing_article is not None:
+					if index is not None:
+						index.remove(existing_article)
+					del articles[old_hash]
+					existing_article.set_hash(article.hash)
+					articles[article.hash] = existing_article
 
 			if existing_article is not None:
+				if index is not None:
+					index.remove(existing_article)
 				existing_article.update_from(article, now)
+				if index is not None:
+					index.add(existing_article)
 				call_hook("article_updated", rawdog, config, existing_article, now)
 			else:
 				articles[article.hash] = article
+				added_articles.add(article.hash)
+				if index is not None:
+					index.add(article)
 				call_hook("article_added", rawdog, config, article, now)
 
 		if config["currentonly"]:
-			for (hash, a) in list(articles.items()):
-				if a.feed == feed and hash not in seen_articles:
-					del articles[hash]
-
+			if index is None:
+				feed_articles = [a for a in list(articles.values()) if a.feed == feed]
+			else:
+				feed_articles = index.get_feed_articles(feed, articles)
+			for a in feed_articles:
+				if a.hash not in seen_articles:
+					del articles[a.hash]
+					if index is not None:
+						index.remove(a)
+
+		self.hash_scheme = hash_scheme
+		if len(added_articles) == 0:
+			stats["unchanged"] += 1
+		self.record_update(now, len(added_articles) != 0)
 		return True
 
 	def get_html_name(self, config):
@@ -742,10 +1549,97 @@ class Feed:
 	def get_keepmin(self, config):
 		return self.args.get("keepmin", config["keepmin"])
 
+	def set_article_summary(self, sort_keys, config):
+		"""Remember the sort keys of the articles from this feed that
+		could be written to the output, given the sort keys of all
+		its articles, so that writing doesn't need to load the feed's
+		state."""
+		if config["maxarticles"] == 0:
+			self.article_summary = None
+		else:
+			top = heapq.nsmallest(config["maxarticles"], sort_keys)
+			self.article_summary = (get_summary_key(config), len(sort_keys), top)
+
+	def get_article_summary(self, config):
+		"""Return a tuple of the number of articles in this feed and
+		the sort keys of those that could be written to the output,
+		or None if there's no up-to-date summary."""
+		# Feeds from older versions of rawdog don't have this.
+		summary = getattr(self, "article_summary", None)
+		if summary is None or summary[0] != get_summary_key(config):
+			return None
+		return summary[1:]
+
+def get_summary_key(config):
+	"""Return the config settings that a feed's article summary depends
+	on."""
+	return (config["sortbyfeeddate"], config["maxarticles"])
+
+# The entry_info fields that rawdog itself uses. Plugins can ask for
+# more using rawdoglib.plugins.keep_article_fields.
+ARTICLE_FIELDS = ["id", "link", "title", "title_detail", "content",
+                  "summary_detail", "author", "author_detail"]
+# The fields of a feedparser detail dict that detail_to_html uses.
+DETAIL_FIELDS = ["type", "value", "base"]
+
+def compact_detail(detail):
+	"""Return a copy of a feedparser detail dict containing only the
+	fields that rawdog uses, with the short strings interned."""
+	result = {}
+	for key in DETAIL_FIELDS:
+		if key in detail:
+			value = detail[key]
+			if key != "value" and isinstance(value, str):
+				value = sys.intern(value)
+			result[key] = value
+	return result
+
+def compact_entry_info(entry_info):
+	"""Return a copy of an entry_info dict containing only the fields
+	that rawdog and plugins use, in a form that doesn't repeat
+	itself."""
+	keep = set(ARTICLE_FIELDS) | rawdoglib.plugins.kept_article_fields
+	extra = keep - set(ARTICLE_FIELDS)
+	result = {}
+	for key, value in list(entry_info.items()):
+		if key in keep:
+			result[key] = value
+
+	if "content" in result and "content" not in extra:
+		# Only the detail that would be displayed is needed, and
+		# the summary isn't displayed at all.
+		detail = select_detail(result["content"])
+		if detail is not None:
+			result["content"] = [compact_detail(detail)]
+			if "summary_detail" not in extra:
+				result.pop("summary_detail", None)
+		else:
+			del result["content"]
+	for key in ("title_detail", "summary_detail"):
+		if key in result and key not in extra:
+			result[key] = compact_detail(result[key])
+	if "title" in result and "title_detail" in result:
+		# Share the string, so it's only pickled once.
+		if result["title"] == result["title_detail"].get("value"):
+			result["title"] = result["title_detail"]["value"]
+	if "author_detail" in result and "author_detail" not in extra:
+		detail = result["author_detail"]
+		result["author_detail"] = dict([(k, detail[k]) for k in ("name", "href", "email") if k in detail])
+		if "name" in detail and "author" not in extra:
+			# author_to_html doesn't need it.
+			result.pop("author", None)
+
+	return result
+
 class Article:
 	"""An article retrieved from an RSS feed."""
 
-	def __init__(self, feed, entry_info, now, sequence):
+	# Articles are stored in large numbers, so avoid having a dict per
+	# article for the common attributes. (Plugins can still add others.)
+	__slots__ = ("feed", "entry_info", "sequence", "date", "hash",
+	             "last_seen", "added", "short_hash", "__dict__")
+
+	def __init__(self, feed, entry_info, now, sequence, hash_scheme="sha1"):
 		self.feed = feed
 		self.entry_info = entry_info
 		self.sequence = sequence
@@ -762,35 +1656,68 @@ class Article:
 			except OverflowError:
 				pass
 
-		self.hash = self.compute_initial_hash()
+		self.hash = self.compute_initial_hash(hash_scheme)
 
 		self.last_seen = now
 		self.added = now
 
-	def compute_initial_hash(self):
-		"""Compute an initial unique hash for an article.
+	def compute_initial_hash(self, hash_scheme="sha1"):
+		"""Compute an initial unique hash for an article, using one of
+		the functions in HASH_SCHEMES.
 		The generated hash must be unique amongst all articles in the
 		system (i.e. it can't just be the article ID, because that
 		would collide if more than one feed included the same
 		article)."""
-		h = hashlib.sha1()
-		def add_hash(s):
-			h.update(s.encode("UTF-8"))
-
-		add_hash(self.feed)
+		# Hashing the parts one after another gives the same result
+		# as hashing them joined together, which is quicker.
+		parts = [self.feed]
 		entry_info = self.entry_info
 		if "title" in entry_info:
-			add_hash(entry_info["title"])
+			parts.append(entry_info["title"])
 		if "link" in entry_info:
-			add_hash(entry_info["link"])
+			parts.append(entry_info["link"])
 		if "content" in entry_info:
 			for content in entry_info["content"]:
-				add_hash(content["value"])
+				parts.append(content["value"])
 		if "summary_detail" in entry_info:
-			add_hash(entry_info["summary_detail"]["value"])
+			parts.append(entry_info["summary_detail"]["value"])
 
+		h = HASH_SCHEMES[hash_scheme]()
+		h.update("".join(parts).encode("UTF-8"))
 		return h.hexdigest()
 
+	def set_hash(self, hash):
+		"""Change the article's hash."""
+		self.hash = hash
+		self.short_hash = None
+
+	def get_short_hash(self):
+		"""Return the short hash of the article's hash, computing it
+		the first time it's needed."""
+		# Articles from older versions of rawdog don't have this.
+		result = getattr(self, "short_hash", None)
+		if result is None:
+			result = short_hash(self.hash)
+			self.short_hash = result
+		return result
+
+	def __setstate__(self, state):
+		if isinstance(state, tuple):
+			# The (dict, slots) pair from the default pickling
+			# for a class with __slots__.
+			(dict_state, slot_state) = state
+			state = {}
+			state.update(dict_state or {})
+			state.update(slot_state or {})
+		# Otherwise it's the dict from an article pickled by an
+		# older version of rawdog.
+		for name, value in list(state.items()):
+			setattr(self, name, value)
+
+	def compact(self):
+		"""Discard the parts of entry_info that aren't needed."""
+		self.entry_info = compact_entry_info(self.entry_info)
+
 	def update_from(self, new_article, now):
 		"""Update this article's contents from a newer article that's
 		been identified to be the same."""
@@ -808,6 +1735,10 @@ class Article:
 		else:
 			return self.added
 
+	def get_sort_key(self, config):
+		"""Return the tuple used to sort articles for output."""
+		return (-self.get_sort_date(config), self.feed, self.sequence, self.hash)
+
 class DayWriter:
 	"""Utility class for writing day sections into a series of articles."""
 
@@ -927,6 +1858,7 @@ class Config:
 		# who has an old config file shouldn't notice a difference
 		# in behaviour on upgrade -- so new options generally
 		# default to False here, and True in the sample file.
+		self.reset_templates()
 		self.config = {
 			"feedslist" : [],
 			"feeddefaults" : {},
@@ -959,10 +1891,41 @@ class Config:
 			"newfeedperiod" : "3h",
 			"changeconfig": False,
 			"numthreads": 1,
+			"fetchengine": "threads",
+			"maxperhost": 0,
+			"hostinterval": 0,
+			"keepalive": False,
+			"skipunchanged": False,
+			"adaptiveperiod": False,
+			"minperiod": 30 * 60,
+			"maxperiod": 24 * 60 * 60,
+			"spreadfeeds": False,
+			"maxfeedsperrun": 0,
+			"updatedeadline": 0,
+			"checkpointfeeds": 0,
+			"checkpointtime": 0,
+			"statecompression": "none",
+			"hashscheme": "sha1",
+			"compactarticles": False,
+			"parseprocesses": 0,
 			"splitstate": False,
+			"statebackend": "pickle",
+			"articlestore": False,
+			"streamoutput": False,
+			"sanitisecache": 0,
+			"incrementalwrite": False,
 			"useids": False,
 			}
 
+	def reset_templates(self):
+		"""Forget the templates loaded using this config, so they'll be
+		loaded (and compiled) again when they're next used."""
+		# Template names mapped to their text, and to the
+		# CompiledTemplates for that text.
+		self.templates = {}
+		self.compiled_templates = {}
+		file_cache.clear()
+
 	def __getitem__(self, key):
 		return self.config[key]
 
@@ -982,6 +1945,11 @@ class Config:
 		"""Load configuration from a config file."""
 		if explicitly_loaded:
 			self.files_loaded.append(filename)
+			# The new file might change which templates are in
+			# use. (Included files are loaded as part of the file
+			# that included them, and reload resets everything
+			# before loading the files again.)
+			self.reset_templates()
 
 		lines = []
 		try:
@@ -1094,8 +2062,63 @@ class Config:
 			self["changeconfig"] = parse_bool(l[1])
 		elif l[0] == "numthreads":
 			self["numthreads"] = int(l[1])
+		elif l[0] == "fetchengine":
+			if l[1] not in ("threads", "asyncio"):
+				raise ValueError("Unknown fetch engine: " + l[1])
+			self["fetchengine"] = l[1]
+		elif l[0] == "keepalive":
+			self["keepalive"] = parse_bool(l[1])
+		elif l[0] == "skipunchanged":
+			self["skipunchanged"] = parse_bool(l[1])
+		elif l[0] == "maxperhost":
+			self["maxperhost"] = int(l[1])
+		elif l[0] == "hostinterval":
+			self["hostinterval"] = parse_time(l[1], "s")
+		elif l[0] == "adaptiveperiod":
+			self["adaptiveperiod"] = parse_bool(l[1])
+		elif l[0] == "minperiod":
+			self["minperiod"] = parse_time(l[1])
+		elif l[0] == "maxperiod":
+			self["maxperiod"] = parse_time(l[1])
+		elif l[0] == "spreadfeeds":
+			self["spreadfeeds"] = parse_bool(l[1])
+		elif l[0] == "maxfeedsperrun":
+			self["maxfeedsperrun"] = int(l[1])
+		elif l[0] == "updatedeadline":
+			self["updatedeadline"] = parse_time(l[1], "s")
+		elif l[0] == "checkpointfeeds":
+			self["checkpointfeeds"] = int(l[1])
+		elif l[0] == "checkpointtime":
+			self["checkpointtime"] = parse_time(l[1], "s")
+		elif l[0] == "parseprocesses":
+			if l[1] == "auto":
+				self["parseprocesses"] = os.cpu_count() or 1
+			else:
+				self["parseprocesses"] = int(l[1])
 		elif l[0] == "splitstate":
 			self["splitstate"] = parse_bool(l[1])
+		elif l[0] == "statebackend":
+			if l[1] not in ("pickle", "sqlite"):
+				raise ValueError("Unknown state backend: " + l[1])
+			self["statebackend"] = l[1]
+		elif l[0] == "statecompression":
+			if l[1] not in COMPRESSORS:
+				raise ValueError("Unknown state compression: " + l[1])
+			self["statecompression"] = l[1]
+		elif l[0] == "hashscheme":
+			if l[1] not in HASH_SCHEMES:
+				raise ValueError("Unknown hash scheme: " + l[1])
+			self["hashscheme"] = l[1]
+		elif l[0] == "compactarticles":
+			self["compactarticles"] = parse_bool(l[1])
+		elif l[0] == "articlestore":
+			self["articlestore"] = parse_bool(l[1])
+		elif l[0] == "incrementalwrite":
+			self["incrementalwrite"] = parse_bool(l[1])
+		elif l[0] == "sanitisecache":
+			self["sanitisecache"] = int(l[1])
+		elif l[0] == "streamoutput":
+			self["streamoutput"] = parse_bool(l[1])
 		elif l[0] == "useids":
 			self["useids"] = parse_bool(l[1])
 		elif l[0] == "include":
@@ -1208,63 +2231,770 @@ def remove_feed(filename, url, config):
 		print("Removing feed " + url, file=sys.stderr)
 		edit_file(filename, RemoveFeedEditor(url).edit)
 
+def get_fetch_host(url):
+	"""Return the host that url will be fetched from, or None if it's not
+	fetched over the network."""
+	parts = urllib.parse.urlsplit(url)
+	if parts.scheme not in ("http", "https"):
+		return None
+	return parts.hostname
+
+class HostScheduler:
+	"""Decide the order in which to fetch a set of feeds. Feeds from
+	different hosts are interleaved, so that no host gets all the
+	workers at once; if max_per_host is positive, no more than that many
+	feeds are fetched from the same host at once, and fetches from the
+	same host start at least min_interval seconds apart.
+
+	This doesn't do any locking itself, so the caller must make sure
+	that only one worker at a time is using it."""
+
+	def __init__(self, jobs, max_per_host=0, min_interval=0):
+		self.max_per_host = max_per_host
+		self.min_interval = min_interval
+		# The jobs waiting for each host, and the hosts with jobs
+		# waiting, in the order they'll be tried.
+		self.queues = {}
+		self.hosts = collections.deque()
+		# The host of each job that's been started.
+		self.job_hosts = {}
+		# The number of jobs in progress for each host.
+		self.active = {}
+		# The time.monotonic() time at which each host can next be
+		# fetched from.
+		self.next_start = {}
+		for (job, host) in jobs:
+			if host not in self.queues:
+				self.queues[host] = collections.deque()
+				self.hosts.append(host)
+			self.queues[host].append(job)
+
+	def is_empty(self):
+		"""Return True if there are no jobs left to start."""
+		return not self.hosts
+
+	def get(self, now):
+		"""Return (job, None) for the next job to start, or (None, wait)
+		if no job can start yet, where wait is the number of seconds
+		until one might be able to, or None if one can't until a job
+		that's in progress is done."""
+		wait = None
+		for i in range(len(self.hosts)):
+			host = self.hosts[0]
+			# Whatever happens, try the next host first next time.
+			self.hosts.rotate(-1)
+			if host is not None:
+				if self.max_per_host > 0 and self.active.get(host, 0) >= self.max_per_host:
+					continue
+				start = self.next_start.get(host, 0)
+				if start > now:
+					if wait is None or start - now < wait:
+						wait = start - now
+					continue
+				self.next_start[host] = now + self.min_interval
+
+			queue = self.queues[host]
+			job = queue.popleft()
+			if not queue:
+				del self.queues[host]
+				self.hosts.remove(host)
+			self.job_hosts[job] = host
+			self.active[host] = self.active.get(host, 0) + 1
+			return (job, None)
+		return (None, wait)
+
+	def done(self, job):
+		"""Record that a job has finished."""
+		self.active[self.job_hosts[job]] -= 1
+
+	def defer_host(self, job):
+		"""Remove the jobs that haven't been started yet for the host of
+		job, and return them."""
+		host = self.job_hosts[job]
+		if host is None or host not in self.queues:
+			return []
+		deferred = list(self.queues.pop(host))
+		self.hosts.remove(host)
+		return deferred
+
+def use_fetch_journal(config):
+	"""Return True if fetched feeds should be recorded in a
+	FetchJournal: that is, if checkpoints are turned on."""
+	return config["checkpointfeeds"] > 0 or config["checkpointtime"] > 0
+
+class FetchJournal:
+	"""A record of the feeds that have been fetched by an update, but
+	whose updates haven't been saved in the state yet, so that if rawdog
+	is killed while it's fetching feeds, the next update can use them
+	rather than fetching them again.
+
+	Each fetched feed's result is written to its own file in the journal
+	directory as soon as it's been parsed, and the file is removed once
+	the state including the feed's update has been saved. Results that
+	can't be pickled, and failed fetches, aren't recorded."""
+
+	dirname = "journal"
+
+	def __init__(self, compression="none"):
+		self.compression = compression
+		# The URLs of the feeds whose updates will be saved at the
+		# next checkpoint.
+		self.applied = []
+		try:
+			os.mkdir(self.dirname)
+		except OSError:
+			# Most likely it already exists.
+			pass
+
+	def get_filename(self, url):
+		return os.path.join(self.dirname, hashlib.sha1(url.encode("UTF-8")).hexdigest() + ".result")
+
+	def add(self, url, result):
+		"""Record the result of fetching a feed. This may be called
+		from any thread."""
+		if "rawdog_exception" in result or "rawdog_timeout" in result:
+			return
+		try:
+			data = dump_state((url, result), self.compression)
+		except Exception:
+			return
+		filename = self.get_filename(url)
+		newname = "%s.new-%d" % (filename, os.getpid())
+		f = open(newname, "wb")
+		f.write(data)
+		f.close()
+		os.rename(newname, filename)
+
+	def load(self, feeds):
+		"""Return a dict mapping URLs to the results recorded by an
+		update that didn't finish, for the feeds in the dict feeds.
+		Results for other feeds are discarded."""
+		results = {}
+		for filename in os.listdir(self.dirname):
+			filename = os.path.join(self.dirname, filename)
+			url = None
+			if filename.endswith(".result"):
+				try:
+					(url, result) = load_state_file(filename)
+				except Exception:
+					pass
+			if url in feeds:
+				results[url] = result
+			else:
+				os.unlink(filename)
+		return results
+
+	def mark_applied(self, url):
+		"""Record that a feed's result has been used to update it."""
+		self.applied.append(url)
+
+	def forget_applied(self):
+		"""Remove the results of the feeds that have been used, once
+		the state including their updates has been saved."""
+		for url in self.applied:
+			try:
+				os.unlink(self.get_filename(url))
+			except OSError:
+				pass
+		self.applied = []
+
 class FeedFetcher:
-	"""Class that will handle fetching a set of feeds in parallel."""
+	"""Class that will handle fetching a set of feeds in parallel.
+
+	Fetching is done in two stages: downloading the feed (which is
+	done by threads or asyncio tasks), and parsing it (which may be
+	done by a pool of processes, so that it can use more than one CPU)."""
 
-	def __init__(self, rawdog, feedlist, config):
+	def __init__(self, rawdog, feedlist, config, journal=None):
 		self.rawdog = rawdog
 		self.config = config
+		# The FetchJournal to record the results in, if any.
+		self.journal = journal
 		self.lock = threading.Lock()
-		self.jobs = set(feedlist)
+		# Notified when a download finishes, so that workers waiting
+		# for a host to become free can try again.
+		self.ready = threading.Condition(self.lock)
+		self.feedlist = feedlist
+		jobs = [(url, get_fetch_host(rawdog.feeds[url].get_fetch_url())) for url in feedlist]
+		self.scheduler = HostScheduler(jobs, config["maxperhost"], config["hostinterval"])
+		# Feeds left until the next run because their server asked
+		# us to back off.
+		self.deferred = []
 		self.results = {}
+		self.parsing = {}
+		self.pool = None
+		# Pools of HTTP connections to reuse, if keepalive is on.
+		self.connections = None
+		self.async_connections = None
+		# The threads that the asyncio engine uses for parsing, and for
+		# feeds that need urllib2.
+		self.executor = None
+		# The time.monotonic() time at which to give up, if
+		# updatedeadline is set.
+		self.deadline = None
+		# Set once run has collected the results, so that any
+		# workers that are still going know to give up.
+		self.stopped = False
+
+	def past_deadline(self):
+		"""Return True if the deadline for fetching has passed."""
+		return self.deadline is not None and time.monotonic() >= self.deadline
+
+	def time_left(self):
+		"""Return the number of seconds until the deadline, or None if
+		there isn't one."""
+		if self.deadline is None:
+			return None
+		return max(0.0, self.deadline - time.monotonic())
+
+	def limit_timeout(self):
+		"""Make sure that the sockets opened for the next fetch will
+		time out soon after the deadline, so that an abandoned fetch
+		doesn't keep its thread running for long. (Not at the deadline
+		itself, which would make a fetch that was going to be abandoned
+		fail with a timeout instead.)"""
+		time_left = self.time_left()
+		if time_left is not None:
+			socket.setdefaulttimeout(min(self.config["timeout"], time_left + 1))
+
+	def start_pool(self, num_jobs):
+		"""Start the pool of parser processes, if one is needed."""
+		num_procs = min(self.config["parseprocesses"], num_jobs)
+		if num_procs < 1:
+			return
+
+		self.config.log("Parsing feeds using ", num_procs, " processes")
+		kwargs = {}
+		if "forkserver" in multiprocessing.get_all_start_methods():
+			# Forking a process that's running threads isn't safe,
+			# so fork workers from a separate server process that
+			# has rawdog already loaded.
+			context = multiprocessing.get_context("forkserver")
+			context.set_forkserver_preload(["rawdoglib.rawdog"])
+			kwargs["mp_context"] = context
+		self.pool = concurrent.futures.ProcessPoolExecutor(num_procs, **kwargs)
+
+	def get_parsed(self, job, download, future):
+		"""Get the result of parsing a download in the pool."""
+		try:
+			result = future.result()
+		except Exception:
+			# The pool couldn't return the result -- for example,
+			# because it contained something that couldn't be
+			# pickled. Parse it here instead.
+			return self.parse(job, download)
+		(wall, cpu) = result.pop("rawdog_parse_time")
+		self.add_parse_time(job, result, wall, cpu)
+		return result
+
+	def parse(self, job, download):
+		"""Parse a download in this thread."""
+		start_wall = time.perf_counter()
+		start_cpu = time.thread_time()
+		result = parse_fetched(download)
+		self.add_parse_time(job, result, time.perf_counter() - start_wall,
+		                    time.thread_time() - start_cpu)
+		return result
+
+	def add_parse_time(self, job, result, wall, cpu):
+		"""Record the time taken to parse a feed, both in the timings
+		and in the result's statistics for the feed."""
+		rawdoglib.timing.add("parse", wall, cpu, job)
+		stats = result.get("rawdog_stats")
+		if stats is not None:
+			stats["parse_time"] = wall
+
+	def finish_job(self, job, download):
+		"""Record that a feed has been downloaded, so that another feed
+		from the same host can be started. If the server asked us to
+		back off, leave the host's other feeds until the next run. The
+		caller must hold the lock."""
+		self.scheduler.done(job)
+		if get_retry_delay(download.get("rawdog_responses"), time.time()) is not None:
+			deferred = self.scheduler.defer_host(job)
+			if deferred:
+				self.config.log("Server asked rawdog to back off; deferring ",
+				                len(deferred), " feeds from the same host as ",
+				                job, " to the next run")
+				self.deferred += deferred
+
+	def next_job(self):
+		"""Wait until a feed can be fetched, and return its URL, or None
+		if there are no more feeds to fetch."""
+		with self.ready:
+			while not (self.stopped or self.past_deadline() or self.scheduler.is_empty()):
+				(job, wait) = self.scheduler.get(time.monotonic())
+				if job is not None:
+					return job
+				time_left = self.time_left()
+				if time_left is not None and (wait is None or time_left < wait):
+					wait = time_left
+				self.ready.wait(wait)
+			return None
 
 	def worker(self, num):
 		rawdog = self.rawdog
 		config = self.config
 
 		while True:
-			with self.lock:
-				try:
-					job = self.jobs.pop()
-				except KeyError:
-					# No jobs left.
-					break
+			job = self.next_job()
+			if job is None:
+				break
 
 			config.log("[", num, "] Fetching feed: ", job)
 			feed = rawdog.feeds[job]
-			call_hook("pre_update_feed", rawdog, config, feed)
-			result = feed.fetch(rawdog, config)
+			download = {}
+			try:
+				with rawdoglib.timing.phase("fetch", job):
+					call_hook("pre_update_feed", rawdog, config, feed)
+					self.limit_timeout()
+					start = time.perf_counter()
+					download = feed.download(rawdog, config, self.connections)
+					download["rawdog_stats"] = get_download_stats(download, time.perf_counter() - start)
+					check_unchanged_body(feed, download, config)
+			finally:
+				with self.ready:
+					self.finish_job(job, download)
+					self.ready.notify_all()
+
+			if self.pool is not None and "rawdog_data" in download:
+				# Carry on with the next download while it's
+				# parsed.
+				with self.lock:
+					if self.stopped:
+						break
+					future = self.pool.submit(parse_fetched_in_process, download)
+					self.parsing[job] = (download, future)
+			else:
+				result = self.parse(job, download)
+				if self.journal is not None:
+					self.journal.add(job, result)
+				with self.lock:
+					if self.stopped:
+						break
+					self.results[job] = result
+
+	async def next_job_async(self, ready):
+		"""As next_job, for the asyncio workers. ready is the
+		asyncio.Condition that's notified when a download finishes."""
+		async with ready:
+			while not (self.past_deadline() or self.scheduler.is_empty()):
+				(job, wait) = self.scheduler.get(time.monotonic())
+				if job is not None:
+					return job
+				try:
+					await asyncio.wait_for(ready.wait(), wait)
+				except asyncio.TimeoutError:
+					pass
+			return None
 
-			with self.lock:
-				self.results[job] = result
+	async def async_worker(self, num, limiter, ready):
+		rawdog = self.rawdog
+		config = self.config
+		loop = asyncio.get_running_loop()
+
+		# Since all the workers run in the same thread, there's no
+		# need for locking here.
+		while True:
+			job = await self.next_job_async(ready)
+			if job is None:
+				break
+
+			config.log("[", num, "] Fetching feed: ", job)
+			feed = rawdog.feeds[job]
+			# Other tasks run while this one's waiting, so only
+			# the wall-clock time means anything here.
+			with rawdoglib.timing.phase("fetch", job, cpu=False):
+				call_hook("pre_update_feed", rawdog, config, feed)
+				self.limit_timeout()
+				start = time.perf_counter()
+				download = await feed.download_async(rawdog, config, limiter, self.connections, self.async_connections, self.executor)
+				download["rawdog_stats"] = get_download_stats(download, time.perf_counter() - start)
+				check_unchanged_body(feed, download, config)
+			async with ready:
+				self.finish_job(job, download)
+				ready.notify_all()
+
+			# Parsing is done outside the event loop's thread, so
+			# that a big feed doesn't hold up the other downloads.
+			if self.pool is not None and "rawdog_data" in download:
+				future = loop.run_in_executor(self.pool, parse_fetched_in_process, download)
+				try:
+					result = await future
+				except Exception:
+					result = await loop.run_in_executor(self.executor, self.parse, job, download)
+				else:
+					(wall, cpu) = result.pop("rawdog_parse_time")
+					self.add_parse_time(job, result, wall, cpu)
+			else:
+				result = await loop.run_in_executor(self.executor, self.parse, job, download)
+			if self.journal is not None:
+				await loop.run_in_executor(self.executor, self.journal.add, job, result)
+			self.results[job] = result
+
+	async def run_async(self, num_workers):
+		limiter = rawdoglib.asyncfetch.HostLimiter(self.config["maxperhost"])
+		if self.config["keepalive"]:
+			self.async_connections = rawdoglib.asyncfetch.ConnectionPool()
+		ready = asyncio.Condition()
+		# Use a separate executor rather than the loop's default one,
+		# since asyncio.run would wait for that to finish.
+		self.executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+		try:
+			workers = asyncio.gather(*[self.async_worker(i, limiter, ready)
+			                           for i in range(num_workers)])
+			try:
+				# Fetches still in progress at the deadline are
+				# cancelled.
+				await asyncio.wait_for(workers, self.time_left())
+			except asyncio.TimeoutError:
+				pass
+		finally:
+			if self.async_connections is not None:
+				self.async_connections.close()
+			self.executor.shutdown(not self.past_deadline(), cancel_futures=True)
 
 	def run(self, max_workers):
 		max_workers = max(max_workers, 1)
-		num_workers = min(max_workers, len(self.jobs))
-
-		self.config.log("Fetching ", len(self.jobs), " feeds using ",
-		                num_workers, " threads")
-		workers = []
-		for i in range(1, num_workers):
-			t = threading.Thread(target=self.worker, args=(i,))
-			t.start()
-			workers.append(t)
-		self.worker(0)
-		for worker in workers:
-			worker.join()
+		num_workers = min(max_workers, len(self.feedlist))
+
+		if self.config["updatedeadline"] > 0:
+			self.deadline = time.monotonic() + self.config["updatedeadline"]
+
+		self.start_pool(len(self.feedlist))
+		if self.config["keepalive"]:
+			self.connections = rawdoglib.connpool.ConnectionPool()
+		try:
+			if self.config["fetchengine"] == "asyncio" and num_workers > 0:
+				self.config.log("Fetching ", len(self.feedlist), " feeds using ",
+				                num_workers, " asyncio tasks")
+				asyncio.run(self.run_async(num_workers))
+			else:
+				self.config.log("Fetching ", len(self.feedlist), " feeds using ",
+				                num_workers, " threads")
+				# If there's a deadline, then all the workers
+				# run in other threads so that this one can stop
+				# waiting for them. Fetches still in progress at
+				# the deadline are abandoned.
+				workers = []
+				for i in range(1, num_workers):
+					workers.append(self.start_worker(i))
+				if self.deadline is None:
+					self.worker(0)
+				elif num_workers > 0:
+					workers.append(self.start_worker(0))
+				for worker in workers:
+					worker.join(self.time_left())
+
+			with self.lock:
+				self.stopped = True
+				parsing = list(self.parsing.items())
+			for job, (download, future) in parsing:
+				if self.past_deadline() and not future.done():
+					future.cancel()
+					continue
+				self.results[job] = self.get_parsed(job, download, future)
+				if self.journal is not None:
+					self.journal.add(job, self.results[job])
+		finally:
+			if self.pool is not None:
+				self.pool.shutdown(not self.past_deadline(), cancel_futures=True)
+			if self.connections is not None:
+				self.connections.close()
+			socket.setdefaulttimeout(self.config["timeout"])
+
+		if self.connections is not None:
+			opened = self.connections.opened
+			reused = self.connections.reused
+			if self.async_connections is not None:
+				opened += self.async_connections.opened
+				reused += self.async_connections.reused
+			self.config.log("HTTP connections: ", opened, " opened, ", reused, " reused")
+		if len(self.results) + len(self.deferred) < len(self.feedlist):
+			self.config.log("Update deadline reached; fetched ", len(self.results),
+			                " of ", len(self.feedlist), " feeds")
 		self.config.log("Fetch complete")
 		return self.results
 
+	def start_worker(self, num):
+		"""Start a worker thread."""
+		t = threading.Thread(target=self.worker, args=(num,))
+		# Don't wait for abandoned fetches to finish before exiting.
+		t.daemon = (self.deadline is not None)
+		t.start()
+		return t
+
+def get_daemon_pid():
+	"""If rawdog.pid names a process that's still running, return its
+	process ID; otherwise return None."""
+	try:
+		f = open("rawdog.pid")
+		pid = int(f.read().strip())
+		f.close()
+	except (IOError, ValueError):
+		return None
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return None
+	except PermissionError:
+		# It exists, but belongs to someone else.
+		pass
+	return pid
+
+def use_splitstate(config):
+	"""Return True if articles should be stored in a separate FeedState
+	for each feed. The SQLite state backend always does this, so that
+	each feed's update can be saved in its own transaction."""
+	return config["splitstate"] or config["statebackend"] == "sqlite"
+
+def use_article_store(config):
+	"""Return True if articles should also be kept in the ArticleStore.
+	The store is built from the split state, so it's only used along
+	with it."""
+	return config["articlestore"] and use_splitstate(config)
+
 class FeedState(Persistable):
 	"""The collection of articles in a feed."""
 
+	persist_tables = ("articles",)
+
 	def __init__(self):
 		Persistable.__init__(self)
 		self.articles = {}
 
+# Hooks whose functions can change what's written to the output file,
+# given the selected articles.
+OUTPUT_HOOKS = ["output_write_files", "output_items_begin",
+                "output_items_heading", "output_items_end", "output_bits",
+                "output_item_bits", "fill_template"]
+
+class OutputCache(Persistable):
+	"""A record of what went into the output file last time it was
+	written.
+
+	fingerprint is a digest of everything that the output file depends
+	on. fragments maps a digest of everything that an article's
+	expansion of the item template depends on to the expansion."""
+
+	persist_tables = ("fragments",)
+
+	def __init__(self):
+		Persistable.__init__(self)
+		self.fingerprint = None
+		self.fragments = {}
+
+class IncrementalWriter:
+	"""Use an OutputCache to avoid writing the output file if it wouldn't
+	change, and to avoid expanding the item template again for articles
+	that haven't changed."""
+
+	def __init__(self, rawdog, config, cache):
+		self.rawdog = rawdog
+		self.config = config
+		self.cache = cache
+		self.feed_keys = {}
+		self.article_keys = {}
+		# The fragment keys used by this write.
+		self.used = set()
+		self.hits = 0
+		self.misses = 0
+
+		# The names of the bits that the item template uses, or None
+		# if a plugin might be expanding templates itself.
+		if has_hook("fill_template"):
+			self.item_names = None
+		else:
+			self.item_names = rawdog.get_compiled_template(config, "item").names()
+
+		settings = [(k, v) for (k, v) in config.config.items() if k != "verbose"]
+		settings.sort(key=lambda item: item[0])
+		context = [
+			repr(settings),
+			get_sanitise_signature(config),
+			locale.setlocale(locale.LC_ALL),
+			repr((time.tzname, time.timezone, time.altzone)),
+			]
+		for name in ("page", "item", "feedlist", "feeditem"):
+			context.append(str(rawdog.get_template(config, name)))
+		for hookname in OUTPUT_HOOKS:
+			context.append(get_hook_signature(hookname))
+		self.context = "\0".join(context)
+
+	def get_feed_key(self, feed):
+		"""Return a string describing the parts of a feed that its
+		articles' item template expansions depend on."""
+		key = self.feed_keys.get(feed.url)
+		if key is None:
+			bits = self.rawdog.get_feed_bits(self.config, feed)
+			if self.item_names is not None:
+				bits = dict([(k, v) for (k, v) in bits.items() if k in self.item_names])
+			key = repr((sorted(feed.args.items()), sorted(bits.items())))
+			self.feed_keys[feed.url] = key
+		return key
+
+	def get_article_key(self, article):
+		"""Return the fragment key for an article."""
+		key = self.article_keys.get(article)
+		if key is None:
+			h = hashlib.sha1()
+			for s in (self.context,
+			          self.get_feed_key(self.rawdog.feeds[article.feed]),
+			          repr((article.hash, article.date, article.added))):
+				h.update(s.encode("UTF-8", "surrogatepass"))
+				h.update(b"\0")
+			h.update(pickle.dumps(article.entry_info, pickle.HIGHEST_PROTOCOL))
+			key = h.hexdigest()
+			self.article_keys[article] = key
+		return key
+
+	def output_changed(self, articles, article_dates):
+		"""Return True if writing the given articles would change the
+		output file, and remember what it will contain."""
+		h = hashlib.sha1()
+		def add_hash(s):
+			h.update(s.encode("UTF-8", "surrogatepass"))
+			h.update(b"\0")
+
+		add_hash(self.context)
+		bits = self.rawdog.get_main_template_bits(self.config)
+		add_hash(repr(sorted(bits.items())))
+		for article in articles:
+			key = self.get_article_key(article)
+			self.used.add(key)
+			add_hash(key + " " + repr(article_dates[article]))
+		fingerprint = h.hexdigest()
+
+		outputfile = self.config["outputfile"]
+		changed = (fingerprint != self.cache.fingerprint
+		           or outputfile == "-"
+		           or not os.path.exists(outputfile))
+		if fingerprint != self.cache.fingerprint:
+			self.cache.fingerprint = fingerprint
+			self.cache.modified()
+		return changed
+
+	def get_fragment(self, article):
+		"""Return the expansion of the item template for an article,
+		reusing the one from the last write if possible."""
+		key = self.get_article_key(article)
+		self.used.add(key)
+		html = self.cache.fragments.get(key)
+		if html is None:
+			self.misses += 1
+			html = self.rawdog.render_article(article, self.config)
+			self.cache.fragments[key] = html
+			self.cache.row_modified("fragments", key)
+		else:
+			self.hits += 1
+		return html
+
+	def finish(self):
+		"""Discard the fragments that weren't used by this write."""
+		for key in list(self.cache.fragments.keys()):
+			if key not in self.used:
+				del self.cache.fragments[key]
+				self.cache.row_modified("fragments", key)
+
+class ArticleIndex:
+	"""An index of a dict of articles, which maps each feed's URL to the
+	hashes of its articles (and a list of them in the order they were
+	added), and each (feed URL, entry ID) pair to the hash of the article
+	with that ID. This must be kept up to date as articles are added and
+	removed; the lookup methods check what they find against the dict,
+	so a stale index won't return the wrong articles, but it might miss
+	some."""
+
+	def __init__(self, articles):
+		# Each feed's URL mapped to a dict of its articles' hashes
+		# to their (added, sequence, hash) keys.
+		self.by_feed = {}
+		# Each feed's URL mapped to a sorted list of those keys,
+		# oldest first.
+		self.by_age = {}
+		self.by_id = {}
+		# The hashes of all the articles in the index.
+		self.hashes = set()
+		for article in list(articles.values()):
+			self.add(article)
+
+	def add(self, article):
+		"""Add an article to the index."""
+		keys = self.by_feed.setdefault(article.feed, {})
+		ages = self.by_age.setdefault(article.feed, [])
+		key = (article.added, article.sequence, article.hash)
+		old_key = keys.get(article.hash)
+		if old_key != key:
+			if old_key is not None:
+				del ages[bisect.bisect_left(ages, old_key)]
+			keys[article.hash] = key
+			bisect.insort(ages, key)
+			self.hashes.add(article.hash)
+		id = article.entry_info.get("id")
+		if id is not None:
+			self.by_id[(article.feed, id)] = article.hash
+
+	def remove(self, article):
+		"""Remove an article from the index."""
+		keys = self.by_feed.get(article.feed)
+		if keys is not None and article.hash in keys:
+			ages = self.by_age[article.feed]
+			del ages[bisect.bisect_left(ages, keys.pop(article.hash))]
+			self.hashes.discard(article.hash)
+			if len(keys) == 0:
+				del self.by_feed[article.feed]
+				del self.by_age[article.feed]
+		key = (article.feed, article.entry_info.get("id"))
+		if self.by_id.get(key) == article.hash:
+			del self.by_id[key]
+
+	def matches(self, articles):
+		"""Return True if the index contains exactly the articles in
+		articles. (If an article has been replaced by another with the
+		same hash, the lookup methods will still notice.)"""
+		# States from older versions of rawdog don't have these.
+		hashes = getattr(self, "hashes", None)
+		if hashes is None or getattr(self, "by_age", None) is None:
+			return False
+		return articles.keys() == hashes
+
+	def get_feed_count(self, url):
+		"""Return the number of articles from the feed with the given
+		URL."""
+		return len(self.by_feed.get(url, ()))
+
+	def iter_feed_articles_by_age(self, url, articles):
+		"""Iterate over the articles from the feed with the given URL,
+		oldest (by the time they were added) first. The index mustn't
+		be changed until the iteration has finished."""
+		for added, sequence, hash in self.by_age.get(url, ()):
+			article = articles.get(hash)
+			if article is not None and article.feed == url:
+				yield article
+
+	def get_feed_articles(self, url, articles):
+		"""Return a list of the articles from the feed with the given
+		URL."""
+		result = []
+		for hash in self.by_feed.get(url, ()):
+			article = articles.get(hash)
+			if article is not None and article.feed == url:
+				result.append(article)
+		return result
+
+	def find_id(self, url, id, articles):
+		"""Return the article from the feed with the given URL that has
+		the given entry ID, or None if there isn't one."""
+		article = articles.get(self.by_id.get((url, id)))
+		if article is not None and article.feed == url and article.entry_info.get("id") == id:
+			return article
+		return None
+
 class Rawdog(Persistable):
 	"""The aggregator itself."""
 
+	persist_tables = ("feeds", "articles", "plugin_storage")
+
 	def __init__(self):
 		Persistable.__init__(self)
 		self.feeds = {}
@@ -1272,6 +3002,41 @@ class Rawdog(Persistable):
 		self.plugin_storage = {}
 		self.state_version = STATE_VERSION
 		self.using_splitstate = None
+		self.article_index = None
+
+	def modified(self, state=True):
+		Persistable.modified(self, state)
+		if state:
+			# Plugins call this to say that they've changed their
+			# storage, without saying which.
+			self.table_modified("plugin_storage")
+
+	def get_article_index(self):
+		"""Return the ArticleIndex for self.articles, building it if
+		it's missing or out of date."""
+		# States from older versions of rawdog don't have this.
+		index = getattr(self, "article_index", None)
+		if index is None or not index.matches(self.articles):
+			index = ArticleIndex(self.articles)
+			self.article_index = index
+			self.modified()
+		return index
+
+	def open_article_store(self, config):
+		"""Open the ArticleStore, adding the articles for any feeds
+		that it doesn't have yet from their split state, and saving it
+		if that or a change of sort order means its index needs
+		rewriting."""
+		store = ArticleStore(persister.compression)
+		store.open()
+		for feed in list(self.feeds.values()):
+			if not store.has_feed(feed.url):
+				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+					store.set_feed(feed.url, list(feedstate.articles.values()))
+		if store.needs_save(config["sortbyfeeddate"]):
+			config.log("Saving article store")
+			store.save(self.feeds, config["sortbyfeeddate"])
+		return store
 
 	def get_plugin_storage(self, plugin):
 		try:
@@ -1280,6 +3045,8 @@ class Rawdog(Persistable):
 			# rawdog before 2.5 didn't have plugin storage.
 			st = {}
 			self.plugin_storage = {plugin: st}
+		# The caller's probably going to change it.
+		self.row_modified("plugin_storage", plugin)
 		return st
 
 	def check_state_version(self):
@@ -1307,20 +3074,26 @@ class Rawdog(Persistable):
 		# so we need to save the old name to load from.
 		old_state = feed.get_state_filename()
 		feed.url = newurl
+		feed.article_summary = None
 		del self.feeds[oldurl]
 		self.feeds[newurl] = feed
+		self.row_modified("feeds", oldurl)
+		self.row_modified("feeds", newurl)
 
-		if config["splitstate"]:
+		if use_splitstate(config):
 			feedstate_p = persister.get(FeedState, old_state)
 			feedstate_p.rename(feed.get_state_filename())
 			with feedstate_p as feedstate:
 				for article in list(feedstate.articles.values()):
 					article.feed = newurl
-				feedstate.modified()
+				feedstate.table_modified("articles")
 		else:
-			for article in list(self.articles.values()):
-				if article.feed == oldurl:
-					article.feed = newurl
+			index = self.get_article_index()
+			for article in index.get_feed_articles(oldurl, self.articles):
+				index.remove(article)
+				article.feed = newurl
+				index.add(article)
+				self.row_modified("articles", article.hash)
 
 		error_fn("The config file has been updated automatically.")
 
@@ -1334,12 +3107,30 @@ class Rawdog(Persistable):
 			print("  Title:", feed.get_html_name(config))
 			print("  Link:", feed_info.get("link"))
 
+	def show_feed_stats(self, config):
+		"""Show the statistics about fetching each feed, with the feeds
+		that have downloaded the most data first."""
+		feeds = list(self.feeds.values())
+		feeds.sort(key=lambda feed: (-feed.get_stats()["bytes"], feed.url))
+		for feed in feeds:
+			stats = feed.describe_stats()
+			print(feed.url)
+			print("  Fetches:", stats["fetches"])
+			print("  Not modified:", stats["not_modified"], "(" + stats["not_modified_percent"] + ")")
+			print("  Unchanged:", stats["unchanged"], "(" + stats["unchanged_percent"] + ")")
+			print("  Errors:", stats["errors"])
+			print("  Bytes received:", stats["bytes"])
+			print("  Average fetch time:", stats["fetch_time"], "s")
+			print("  Average parse time:", stats["parse_time"], "s")
+
 	def sync_from_config(self, config):
 		"""Update rawdog's internal state to match the
 		configuration."""
+		start_wall = time.perf_counter()
+		start_cpu = time.thread_time()
 
 		# Make sure the splitstate directory exists.
-		if config["splitstate"]:
+		if config["splitstate"] and config["statebackend"] != "sqlite":
 			try:
 				os.mkdir("feeds")
 			except OSError:
@@ -1355,18 +3146,23 @@ class Rawdog(Persistable):
 			# file.
 			u = False
 		if u is None:
-			self.using_splitstate = config["splitstate"]
-		elif u != config["splitstate"]:
-			if config["splitstate"]:
+			self.using_splitstate = use_splitstate(config)
+		elif u != use_splitstate(config):
+			for feed in list(self.feeds.values()):
+				feed.article_summary = None
+			self.table_modified("feeds")
+			if use_splitstate(config):
 				config.log("Converting to split state files")
+				index = self.get_article_index()
 				for feed_hash, feed in list(self.feeds.items()):
 					with persister.get(FeedState, feed.get_state_filename()) as feedstate:
 						feedstate.articles = {}
-						for article_hash, article in list(self.articles.items()):
-							if article.feed == feed_hash:
-								feedstate.articles[article_hash] = article
-						feedstate.modified()
+						for article in index.get_feed_articles(feed_hash, self.articles):
+							feedstate.articles[article.hash] = article
+						feedstate.table_modified("articles")
 				self.articles = {}
+				self.article_index = None
+				self.table_modified("articles")
 			else:
 				config.log("Converting to single state file")
 				self.articles = {}
@@ -1375,10 +3171,11 @@ class Rawdog(Persistable):
 						for article_hash, article in list(feedstate.articles.items()):
 							self.articles[article_hash] = article
 						feedstate.articles = {}
-						feedstate.modified()
+						feedstate.table_modified("articles")
 					persister.delete(feed.get_state_filename())
+				self.table_modified("articles")
 			self.modified()
-			self.using_splitstate = config["splitstate"]
+			self.using_splitstate = use_splitstate(config)
 
 		seen_feeds = set()
 		for (url, period, args) in config["feedslist"]:
@@ -1386,30 +3183,36 @@ class Rawdog(Persistable):
 			if url not in self.feeds:
 				config.log("Adding new feed: ", url)
 				self.feeds[url] = Feed(url)
-				self.modified()
+				self.row_modified("feeds", url)
 			feed = self.feeds[url]
 			if feed.period != period:
 				config.log("Changed feed period: ", url)
 				feed.period = period
-				self.modified()
+				# Start scheduling it again from the new period.
+				feed.next_update = None
+				self.row_modified("feeds", url)
 			newargs = {}
 			newargs.update(config["feeddefaults"])
 			newargs.update(args)
 			if feed.args != newargs:
 				config.log("Changed feed options: ", url)
 				feed.args = newargs
-				self.modified()
+				self.row_modified("feeds", url)
 		for url in list(self.feeds.keys()):
 			if url not in seen_feeds:
 				config.log("Removing feed: ", url)
-				if config["splitstate"]:
+				if use_splitstate(config):
 					persister.delete(self.feeds[url].get_state_filename())
 				else:
-					for key, article in list(self.articles.items()):
-						if article.feed == url:
-							del self.articles[key]
+					index = self.get_article_index()
+					for article in index.get_feed_articles(url, self.articles):
+						del self.articles[article.hash]
+						index.remove(article)
+						self.row_modified("articles", article.hash)
 				del self.feeds[url]
-				self.modified()
+				self.row_modified("feeds", url)
+
+		rawdoglib.timing.add("sync", time.perf_counter() - start_wall, time.thread_time() - start_cpu)
 
 	def update(self, config, feedurl=None):
 		"""Perform the update action: check feeds for new articles, and
@@ -1421,7 +3224,16 @@ class Rawdog(Persistable):
 
 		if feedurl is None:
 			update_feeds = [url for url in list(self.feeds.keys())
-			                    if self.feeds[url].needs_update(now)]
+			                    if self.feeds[url].needs_update(now, config)]
+
+			maxfeeds = config["maxfeedsperrun"]
+			if maxfeeds > 0 and len(update_feeds) > maxfeeds:
+				# Update the feeds that have been waiting longest,
+				# and leave the rest until the next run.
+				by_due = sorted(update_feeds, key=lambda url: self.feeds[url].get_next_update(config))
+				chosen = set(by_due[:maxfeeds])
+				config.log("Deferring ", len(update_feeds) - maxfeeds, " feeds to the next run")
+				update_feeds = [url for url in update_feeds if url in chosen]
 		elif feedurl in self.feeds:
 			update_feeds = [feedurl]
 			self.feeds[feedurl].etag = None
@@ -1430,89 +3242,321 @@ class Rawdog(Persistable):
 			print("No such feed: " + feedurl)
 			update_feeds = []
 
+		# If an earlier update was interrupted, use the feeds that it
+		# had already fetched rather than fetching them again.
+		journal = None
+		replayed = {}
+		if use_fetch_journal(config):
+			journal = FetchJournal(config["statecompression"])
+			replayed = journal.load(self.feeds)
+			if replayed:
+				config.log("Using ", len(replayed), " feeds fetched by an interrupted update")
+				update_feeds += [url for url in sorted(replayed.keys()) if url not in update_feeds]
+
 		numfeeds = len(update_feeds)
 		config.log("Will update ", numfeeds, " feeds")
 
-		fetcher = FeedFetcher(self, update_feeds, config)
+		fetcher = FeedFetcher(self, [url for url in update_feeds if url not in replayed], config, journal)
 		fetched = fetcher.run(config["numthreads"])
+		fetched.update(replayed)
 
 		seen_some_items = set()
-		def do_expiry(articles):
-			"""Expire articles from a list. Return True if any
-			articles were expired."""
-
-			feedcounts = {}
-			for key, article in list(articles.items()):
-				url = article.feed
-				feedcounts[url] = feedcounts.get(url, 0) + 1
+		expiry_time = [0.0]
+		def do_expiry(articles, index=None):
+			"""Expire articles from a list, keeping index (if
+			given) up to date. Return True if any articles were
+			expired."""
+			start_time = time.perf_counter()
+			start_cpu = time.thread_time()
+
+			# The articles of each feed that might have articles
+			# to expire, oldest first, and how many there are.
+			if index is None:
+				# This is a single feed's split state, so
+				# there's no index to walk.
+				feed_articles = {}
+				for article in list(articles.values()):
+					feed_articles.setdefault(article.feed, []).append(article)
+				for feed_list in list(feed_articles.values()):
+					feed_list.sort(key=lambda a: (a.added, a.sequence, a.hash))
+				feed_articles = [(url, feed_list, len(feed_list))
+				                 for url, feed_list in list(feed_articles.items())]
+			else:
+				feed_articles = [(url, index.iter_feed_articles_by_age(url, articles), index.get_feed_count(url))
+				                 for url in list(index.by_feed.keys())
+				                 if url in seen_some_items or url not in self.feeds]
+
+			# For each feed, make a list of the articles to expire,
+			# oldest first.
+			expiry_lists = []
+			expireage = config["expireage"]
+			for url, by_age, remaining in feed_articles:
+				if url not in self.feeds:
+					expiry_lists.append([(a.added, a.sequence, a.hash, a) for a in by_age])
+					continue
+				if url not in seen_some_items:
+					continue
 
-			expiry_list = []
-			feedcounts = {}
-			for key, article in list(articles.items()):
-				url = article.feed
-				feedcounts[url] = feedcounts.get(url, 0) + 1
-				expiry_list.append((article.added, article.sequence, key, article))
-			expiry_list.sort()
+				keepmin = self.feeds[url].get_keepmin(config)
+				expire = []
+				for article in by_age:
+					# An article can only expire if it was
+					# last seen (and thus added) more than
+					# expireage ago, so none of the newer
+					# ones can.
+					if remaining <= keepmin or (now - article.added) <= expireage:
+						break
+					if article.can_expire(now, config):
+						expire.append((article.added, article.sequence, article.hash, article))
+						remaining -= 1
+				expiry_lists.append(expire)
 
 			count = 0
-			for date, seq, key, article in expiry_list:
+			for added, seq, hash, article in heapq.merge(*expiry_lists):
 				url = article.feed
 				if url not in self.feeds:
 					config.log("Expired article for nonexistent feed: ", url)
-					count += 1
-					del articles[key]
-					continue
-				if (url in seen_some_items
-				    and url in self.feeds
-				    and article.can_expire(now, config)
-				    and feedcounts[url] > self.feeds[url].get_keepmin(config)):
+				else:
 					call_hook("article_expired", self, config, article, now)
-					count += 1
-					feedcounts[url] -= 1
-					del articles[key]
+				count += 1
+				del articles[hash]
+				if index is not None:
+					index.remove(article)
 			config.log("Expired ", count, " articles, leaving ", len(articles))
 
+			taken = time.perf_counter() - start_time
+			expiry_time[0] += taken
+			rawdoglib.timing.add("expiry", taken, time.thread_time() - start_cpu)
 			return count > 0
 
+		if len(fetched) < numfeeds:
+			# The deadline was reached, or a server asked us to
+			# back off. Any feeds that weren't fetched will be due
+			# first next time.
+			update_feeds = [url for url in update_feeds if url in fetched]
+			numfeeds = len(update_feeds)
+
+		if use_article_store(config):
+			store = self.open_article_store(config)
+		else:
+			# Don't leave an out-of-date store around to be used
+			# if it's turned on again.
+			store = None
+			ArticleStore().delete()
+
+		if not use_splitstate(config):
+			# Check that the index is up to date once, rather than
+			# for each feed; the updates below keep it up to date.
+			index = self.get_article_index()
+
 		count = 0
+		last_checkpoint = (0, time.monotonic())
 		for url in update_feeds:
+			if self.needs_checkpoint(config, count, last_checkpoint):
+				if store is not None and store.needs_save(config["sortbyfeeddate"]):
+					store.save(self.feeds, config["sortbyfeeddate"])
+				self.checkpoint(config)
+				if journal is not None:
+					journal.forget_applied()
+				last_checkpoint = (count, time.monotonic())
+
 			count += 1
 			config.log("Updating feed ", count, " of ", numfeeds, ": ", url)
 			feed = self.feeds[url]
 
-			if config["splitstate"]:
+			if use_splitstate(config):
 				feedstate_p = persister.get(FeedState, feed.get_state_filename())
 				feedstate = feedstate_p.open()
 				articles = feedstate.articles
+				index = None
 			else:
 				articles = self.articles
 
 			content = fetched[url]
-			call_hook("mid_update_feed", self, config, feed, content)
-			rc = feed.update(self, now, config, articles, content)
-			url = feed.url
-			call_hook("post_update_feed", self, config, feed, rc)
+			if journal is not None:
+				journal.mark_applied(url)
+			with rawdoglib.timing.phase("update", url):
+				call_hook("mid_update_feed", self, config, feed, content)
+				rc = feed.update(self, now, config, articles, content, index)
+				feed.schedule_update(now, config, content)
+				url = feed.url
+				call_hook("post_update_feed", self, config, feed, rc)
+			self.row_modified("feeds", url)
+			changed = False
 			if rc:
 				seen_some_items.add(url)
-				if config["splitstate"]:
-					feedstate.modified()
+				changed = True
+				if not use_splitstate(config):
+					self.table_modified("articles")
 
-			if config["splitstate"]:
+			if use_splitstate(config):
 				if do_expiry(articles):
-					feedstate.modified()
+					changed = True
+				if changed:
+					feedstate.table_modified("articles")
+				feed.set_article_summary([a.get_sort_key(config) for a in list(articles.values())], config)
+				# Only write the feed's articles to the store again
+				# if they've changed (or the feed's URL has), so
+				# that unchanged feeds cost nothing.
+				if store is not None and (changed or not store.has_feed(url)):
+					store.set_feed(url, list(articles.values()))
 				feedstate_p.close()
 
-		if config["splitstate"]:
+		if store is not None:
+			if store.needs_save(config["sortbyfeeddate"]):
+				store.save(self.feeds, config["sortbyfeeddate"])
+			store.close()
+
+		if use_splitstate(config):
 			self.articles = {}
-		else:
-			do_expiry(self.articles)
+		elif do_expiry(self.articles, self.get_article_index()):
+			self.table_modified("articles")
+		config.log("Spent %.3f seconds expiring articles" % expiry_time[0])
 
 		self.modified()
+		if journal is not None:
+			# The fetched feeds aren't needed once the state that
+			# includes their updates has been saved.
+			self.checkpoint(config)
+			journal.forget_applied()
 		config.log("Finished update")
 
+	def needs_checkpoint(self, config, count, last_checkpoint):
+		"""Return True if a checkpoint should be saved, given the
+		number of feeds updated so far, and the number of feeds and
+		time.monotonic() time at the last checkpoint."""
+		(last_count, last_time) = last_checkpoint
+		if count == last_count:
+			return False
+		if config["checkpointfeeds"] > 0 and count - last_count >= config["checkpointfeeds"]:
+			return True
+		if config["checkpointtime"] > 0 and time.monotonic() - last_time >= config["checkpointtime"]:
+			return True
+		return False
+
+	def checkpoint(self, config):
+		"""Save the state in the middle of an update, so that the feeds
+		updated so far won't need updating again if rawdog is
+		interrupted."""
+		if persister is None:
+			return
+		config.log("Saving checkpoint")
+		self.modified()
+		persister.save("state")
+
+	def reload_config(self, config):
+		"""Reload the config files. If there's an error, complain and
+		carry on with the old config."""
+		old_config = config.config
+		old_templates = (config.templates, config.compiled_templates)
+		old_file_cache = dict(file_cache)
+		verbose = config["verbose"]
+		try:
+			config.reload()
+		except ConfigError as err:
+			print("Error reloading config:", file=sys.stderr)
+			print(err, file=sys.stderr)
+			config.config = old_config
+			(config.templates, config.compiled_templates) = old_templates
+			file_cache.clear()
+			file_cache.update(old_file_cache)
+			return
+		if verbose:
+			config["verbose"] = True
+		self.sync_from_config(config)
+
+	def daemon(self, config):
+		"""Run as a daemon: update the feeds as they become due, and
+		write the output after each update, until stopped by SIGINT or
+		SIGTERM. The config files are reloaded on SIGHUP, or when they
+		change. The state is saved after each update. An error during
+		an update is reported, and the daemon carries on with the next
+		one."""
+
+		signals = set()
+		wakeup = threading.Event()
+		def handle_signal(signum, frame):
+			signals.add(signum)
+			wakeup.set()
+		old_handlers = {}
+		for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+			old_handlers[signum] = signal.signal(signum, handle_signal)
+
+		def get_mtimes():
+			mtimes = []
+			for filename in config.files_loaded:
+				try:
+					mtimes.append(os.stat(filename).st_mtime)
+				except OSError:
+					mtimes.append(None)
+			return mtimes
+
+		f = open("rawdog.pid", "w")
+		f.write("%d\n" % os.getpid())
+		f.close()
+
+		config.log("Starting daemon")
+		try:
+			config_mtimes = get_mtimes()
+			last_run = None
+			while not (signal.SIGINT in signals or signal.SIGTERM in signals):
+				if signal.SIGHUP in signals or get_mtimes() != config_mtimes:
+					signals.discard(signal.SIGHUP)
+					self.reload_config(config)
+					config_mtimes = get_mtimes()
+					# Update any new feeds straight away.
+					last_run = None
+
+				# Don't update more than once a minute, even
+				# if some feeds have very short periods.
+				next_run = min([feed.get_next_update(config) for feed in list(self.feeds.values())] + [time.time() + 60])
+				if last_run is not None:
+					next_run = max(next_run, last_run + 60)
+
+				wait = next_run - time.time()
+				if wait > 0:
+					# Wake up at least once a minute to check
+					# whether the config has changed.
+					wakeup.wait(min(wait, 60))
+					wakeup.clear()
+					continue
+
+				last_run = time.time()
+				try:
+					self.update(config)
+					self.write(config)
+					self.checkpoint(config)
+				except Exception:
+					from traceback import print_exc
+					print("Error in daemon update:", file=sys.stderr)
+					print_exc()
+		finally:
+			config.log("Stopping daemon")
+			os.unlink("rawdog.pid")
+			for signum, handler in list(old_handlers.items()):
+				signal.signal(signum, handler)
+
 	def get_template(self, config, name="page"):
 		"""Return the contents of a template."""
 
+		template = config.templates.get(name)
+		if template is None:
+			template = self.load_template(config, name)
+			config.templates[name] = template
+		return template
+
+	def get_compiled_template(self, config, name="page"):
+		"""Return a template as a CompiledTemplate, compiling it the
+		first time it's used with this config."""
+		compiled = config.compiled_templates.get(name)
+		if compiled is None:
+			compiled = CompiledTemplate(self.get_template(config, name))
+			config.compiled_templates[name] = compiled
+		return compiled
+
+	def load_template(self, config, name):
+		"""Load or generate a template."""
+
 		filename = config.get(name + "template", "default")
 		if filename != "default":
 			return load_file(filename)
@@ -1596,6 +3640,13 @@ __feeditems__
 
 	def write_article(self, f, article, config):
 		"""Write an article to the given file."""
+		if incremental_writer is not None:
+			f.write(incremental_writer.get_fragment(article))
+		else:
+			f.write(self.render_article(article, config))
+
+	def render_article(self, article, config):
+		"""Return the expansion of the item template for an article."""
 		feed = self.feeds[article.feed]
 		entry_info = article.entry_info
 
@@ -1646,7 +3697,7 @@ __feeditems__
 		else:
 			itembits["title"] = '<a href="' + string_to_html(link, config) + '">' + title + '</a>'
 
-		itembits["hash"] = short_hash(article.hash)
+		itembits["hash"] = article.get_short_hash()
 
 		if description is not None:
 			itembits["description"] = description
@@ -1667,7 +3718,8 @@ __feeditems__
 		#print(itembits)
 		call_hook("output_item_bits", self, config, feed, article, itembits)
 		itemtemplate = self.get_template(config, "item")
-		f.write(fill_template(itemtemplate, itembits))
+		return fill_template(itemtemplate, itembits,
+		                     self.get_compiled_template(config, "item"))
 
 	def write_remove_dups(self, articles, config, now):
 		"""Filter the list of articles to remove articles that are too
@@ -1717,19 +3769,22 @@ __feeditems__
 
 		bits = {}
 		bits["feed_id"] = feed.get_id(config)
-		bits["feed_hash"] = short_hash(feed.url)
+		bits["feed_hash"] = feed.get_short_hash()
 		bits["feed_title"] = feed.get_html_link(config)
 		bits["feed_title_no_link"] = detail_to_html(feed.feed_info.get("title_detail"), True, config)
 		bits["feed_url"] = string_to_html(feed.url, config)
 		bits["feed_icon"] = '<a class="xmlbutton" href="' + libhtml.escape(feed.url) + '">XML</a>'
 		bits["feed_last_update"] = format_time(feed.last_update, config)
-		bits["feed_next_update"] = format_time(feed.last_update + feed.period, config)
+		bits["feed_next_update"] = format_time(feed.get_next_update(config), config)
+		for key, value in feed.describe_stats().items():
+			bits["feed_" + key] = value
 		return bits
 
 	def write_feeditem(self, f, feed, config):
 		"""Write a feed list item."""
 		bits = self.get_feed_bits(config, feed)
-		f.write(fill_template(self.get_template(config, "feeditem"), bits))
+		f.write(fill_template(self.get_template(config, "feeditem"), bits,
+		                      self.get_compiled_template(config, "feeditem")))
 
 	def write_feedlist(self, f, config):
 		"""Write the feed list."""
@@ -1744,7 +3799,8 @@ __feeditems__
 		bits["feeditems"] = feeditems.getvalue()
 		feeditems.close()
 
-		f.write(fill_template(self.get_template(config, "feedlist"), bits))
+		f.write(fill_template(self.get_template(config, "feedlist"), bits,
+		                      self.get_compiled_template(config, "feedlist")))
 
 	def get_main_template_bits(self, config):
 		"""Get the bits that are used in the default main template,
@@ -1764,9 +3820,8 @@ __feeditems__
 
 		return bits
 
-	def write_output_file(self, articles, article_dates, config):
-		"""Write a regular rawdog HTML output file."""
-		f = StringIO()
+	def write_items(self, f, articles, article_dates, config):
+		"""Write the expansion of __items__ to f."""
 		dw = DayWriter(f, config)
 		call_hook("output_items_begin", self, config, f)
 
@@ -1779,12 +3834,24 @@ __feeditems__
 		dw.close()
 		call_hook("output_items_end", self, config, f)
 
+	def write_output_file(self, articles, article_dates, config):
+		"""Write a regular rawdog HTML output file."""
+		if config["streamoutput"] and not has_hook("fill_template"):
+			page = split_template(self.get_template(config, "page"), "items")
+			if page is not None:
+				self.write_output_file_streaming(page, articles, article_dates, config)
+				return
+
+		f = StringIO()
+		self.write_items(f, articles, article_dates, config)
+
 		bits = self.get_main_template_bits(config)
 		bits["items"] = f.getvalue()
 		f.close()
 		bits["num_items"] = str(len(articles))
 		call_hook("output_bits", self, config, bits)
-		s = fill_template(self.get_template(config, "page"), bits)
+		s = fill_template(self.get_template(config, "page"), bits,
+		                  self.get_compiled_template(config, "page"))
 		outputfile = config["outputfile"]
 		if outputfile == "-":
 			write_ascii(sys.stdout, s, config)
@@ -1795,30 +3862,140 @@ __feeditems__
 			f.close()
 			os.rename(outputfile + ".new", outputfile)
 
+	def write_output_file_streaming(self, page, articles, article_dates, config):
+		"""Write a regular rawdog HTML output file, writing items
+		directly to the file as they're generated rather than building
+		the whole page in memory first. page is the page template,
+		split at __items__ by split_template."""
+		(header, footer) = page
+
+		bits = self.get_main_template_bits(config)
+		bits["num_items"] = str(len(articles))
+		call_hook("output_bits", self, config, bits)
+
+		outputfile = config["outputfile"]
+		if outputfile == "-":
+			f = sys.stdout
+		else:
+			config.log("Writing output file: ", outputfile)
+			f = open(outputfile + ".new", "w")
+		write_ascii(f, fill_template(header, bits), config)
+		self.write_items(f, articles, article_dates, config)
+		write_ascii(f, fill_template(footer, bits), config)
+		if outputfile != "-":
+			f.close()
+			os.rename(outputfile + ".new", outputfile)
+
 	def write(self, config):
 		"""Perform the write action: write articles to the output
 		file."""
 		config.log("Starting write")
+
+		global sanitise_cache, incremental_writer
+		output_p = None
+		if config["incrementalwrite"]:
+			output_p = persister.get(OutputCache, "outputcache.state")
+			output_cache = output_p.open()
+			if output_cache is None:
+				output_p = None
+			else:
+				incremental_writer = IncrementalWriter(self, config, output_cache)
+
+		cache_p = None
+		if config["sanitisecache"] > 0:
+			cache_p = persister.get(SanitiseCache, "sanitisecache.state")
+			sanitise_cache = cache_p.open()
+			if sanitise_cache is None:
+				cache_p = None
+			else:
+				sanitise_cache.start(config)
+
+		try:
+			self.write_articles(config)
+		finally:
+			cache = sanitise_cache
+			sanitise_cache = None
+			writer = incremental_writer
+			incremental_writer = None
+
+		if output_p is not None:
+			config.log("Item template cache: ", writer.hits, " hits, ", writer.misses, " misses")
+			writer.finish()
+			output_p.close()
+
+		if cache_p is not None:
+			config.log("Sanitised HTML cache: ", cache.hits, " hits, ", cache.misses, " misses")
+			cache.trim(config["sanitisecache"])
+			cache_p.close()
+
+		config.log("Finished write")
+
+	def write_articles(self, config):
+		"""Select the articles to write, and write them to the output
+		file."""
 		now = time.time()
 
 		def list_articles(articles):
-			return [(-a.get_sort_date(config), a.feed, a.sequence, a.hash) for a in list(articles.values())]
-		if config["splitstate"]:
+			return [a.get_sort_key(config) for a in list(articles.values())]
+
+		# If nothing else wants to see the whole list, we only need
+		# to find the first maxarticles articles.
+		select_top = (config["maxarticles"] != 0 and not has_hook("output_sort_articles"))
+
+		store = None
+		if use_article_store(config):
+			# The store's index is in output order, so we only
+			# need to read the records for the articles we're
+			# going to write.
+			store = self.open_article_store(config)
+			limit = None
+			if select_top:
+				limit = config["maxarticles"]
+			records = store.get_records(self.feeds, config["sortbyfeeddate"], limit)
+			article_list = [key for (key, record) in records]
+			numarticles = store.get_count(self.feeds)
+		elif use_splitstate(config):
+			# Use the feeds' summaries where possible, so we
+			# only need to load the state for feeds that have
+			# articles to write.
 			article_list = []
+			numarticles = 0
 			for feed in list(self.feeds.values()):
-				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
-					article_list += list_articles(feedstate.articles)
+				summary = None
+				if select_top:
+					summary = feed.get_article_summary(config)
+				if summary is None:
+					with persister.get(FeedState, feed.get_state_filename()) as feedstate:
+						feed_list = list_articles(feedstate.articles)
+					if select_top:
+						feed.set_article_summary(feed_list, config)
+						self.row_modified("feeds", feed.url)
+					summary = (len(feed_list), feed_list)
+				numarticles += summary[0]
+				article_list += summary[1]
 		else:
 			article_list = list_articles(self.articles)
-		numarticles = len(article_list)
+			numarticles = len(article_list)
 
-		if not call_hook("output_sort_articles", self, config, article_list):
-			article_list.sort()
+		with rawdoglib.timing.phase("sort"):
+			if select_top:
+				article_list = heapq.nsmallest(config["maxarticles"], article_list)
+			else:
+				if not call_hook("output_sort_articles", self, config, article_list):
+					article_list.sort()
 
-		if config["maxarticles"] != 0:
-			article_list = article_list[:config["maxarticles"]]
+				if config["maxarticles"] != 0:
+					article_list = article_list[:config["maxarticles"]]
 
-		if config["splitstate"]:
+		if store is not None:
+			records = dict([(key[3], record) for (key, record) in records])
+			found = {}
+			for (date, feed_url, seq, hash) in article_list:
+				record = records.get(hash)
+				if record is not None:
+					found[hash] = store.load(record)
+			store.close()
+		elif use_splitstate(config):
 			wanted = {}
 			for (date, feed_url, seq, hash) in article_list:
 				if not feed_url in self.feeds:
@@ -1835,7 +4012,9 @@ __feeditems__
 				feed = self.feeds[feed_url]
 				with persister.get(FeedState, feed.get_state_filename()) as feedstate:
 					for hash in article_hashes:
-						found[hash] = feedstate.articles[hash]
+						article = feedstate.articles.get(hash)
+						if article is not None:
+							found[hash] = article
 		else:
 			found = self.articles
 
@@ -1856,11 +4035,13 @@ __feeditems__
 
 		config.log("Selected ", len(articles), " of ", numarticles, " articles to write; ignored ", dup_count, " duplicates")
 
+		if incremental_writer is not None and not incremental_writer.output_changed(articles, article_dates):
+			config.log("Output unchanged; not writing output file")
+			return
+
 		if not call_hook("output_write_files", self, config, articles, article_dates):
 			self.write_output_file(articles, article_dates, config)
 
-		config.log("Finished write")
-
 def usage():
 	"""Display usage information."""
 	print("""rawdog, version """ + VERSION + """
@@ -1872,6 +4053,7 @@ General options (use only once):
 -v, --verbose                Print more detailed status information
 -V|--log FILE                Append detailed status information to FILE
 -W, --no-lock-wait           Exit silently if state file is locked
+--stats FILE                 Write timing statistics to FILE as JSON
 
 Actions (performed in order given):
 -a|--add URL                 Try to find a feed associated with URL and
@@ -1884,6 +4066,9 @@ Actions (performed in order given):
                              (TEMPLATE may be: page item feedlist feeditem)
 -u, --update                 Fetch data from feeds and store it
 -w, --write                  Write out HTML output
+--daemon                     Keep running, updating feeds when they're
+                             due and writing output after each update
+--feed-stats                 Show statistics about fetching each feed
 
 Special actions (all other options are ignored if one of these is specified):
 --dump URL                   Show what rawdog's parser returns for URL
@@ -1909,6 +4094,7 @@ def main(argv):
 			"config=",
 			"dir=",
 			"dump=",
+			"feed-stats",
 			"find=",
 			"help",
 			"list",
@@ -1919,8 +4105,10 @@ def main(argv):
 			"show=",
 			"show-itemtemplate",
 			"show-template",
+			"stats=",
 			"update",
 			"update-feed=",
+			"daemon",
 			"verbose",
 			"write",
 			]
@@ -1940,6 +4128,7 @@ def main(argv):
 		statedir = None
 	verbose = False
 	logfile_name = None
+	stats_file = None
 	locking = True
 	no_lock_wait = False
 	for o, a in optlist:
@@ -1967,6 +4156,8 @@ def main(argv):
 			logfile_name = a
 		elif o in ("-W", "--no-lock-wait"):
 			no_lock_wait = True
+		elif o == "--stats":
+			stats_file = os.path.abspath(a)
 	if statedir is None:
 		print("$HOME not set and state dir not explicitly specified; please use -d/--dir")
 		return 1
@@ -1979,10 +4170,20 @@ def main(argv):
 
 	sys.path.append(".")
 
+	if ("--daemon", "") in optlist:
+		pid = get_daemon_pid()
+		if pid is not None:
+			print("rawdog is already running as a daemon (process " + str(pid) + ")", file=sys.stderr)
+			return 1
+
+	if stats_file is not None or verbose or logfile_name is not None:
+		rawdoglib.timing.start()
+
 	config = Config(locking, logfile_name)
 	def load_config(fn):
 		try:
-			config.load(fn)
+			with rawdoglib.timing.phase("config"):
+				config.load(fn)
 		except ConfigError as err:
 			print("In " + fn + ":", file=sys.stderr)
 			print(err, file=sys.stderr)
@@ -2025,6 +4226,8 @@ def main(argv):
 			rawdog.update(config, a)
 		elif o in ("-l", "--list"):
 			rawdog.list(config)
+		elif o == "--feed-stats":
+			rawdog.show_feed_stats(config)
 		elif o in ("-r", "--remove"):
 			remove_feed("config", a, config)
 			config.reload()
@@ -2039,9 +4242,17 @@ def main(argv):
 			rawdog.update(config)
 		elif o in ("-w", "--write"):
 			rawdog.write(config)
+		elif o == "--daemon":
+			rawdog.daemon(config)
 
 	call_hook("shutdown", rawdog, config)
 
 	rawdog_p.close()
 
+	timings = rawdoglib.timing.timings
+	if timings is not None:
+		timings.log_summary(config.log)
+		if stats_file is not None:
+			timings.write_report(stats_file)
+
 	return 0
@@ -0,0 +1,168 @@
+# timing: record how long the parts of a rawdog run take.
+# Copyright 2026 The rawdog contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Until start() has been called, timing is turned off, and the functions
+# here do nothing and cost very little.
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Timings:
+	"""Totals of the wall-clock and CPU time spent in each phase of a
+	run, in each phase for each feed, and in each hook function.
+
+	CPU time is measured for the thread doing the work, so phases that
+	run in several threads at once are still measured correctly. Phases
+	can be nested (for example, loading the config includes loading
+	plugins), so the totals for different phases can overlap."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.phases = {}
+		self.feeds = {}
+		self.hooks = {}
+		self.start_wall = time.perf_counter()
+		self.start_cpu = time.process_time()
+
+	def add(self, name, wall, cpu, feed=None):
+		"""Add time spent in a phase (for a feed, if feed is the URL
+		of one)."""
+		with self.lock:
+			add_total(self.phases, name, wall, cpu)
+			if feed is not None:
+				add_total(self.feeds.setdefault(feed, {}), name, wall, cpu)
+
+	@contextlib.contextmanager
+	def phase(self, name, feed=None, cpu=True):
+		"""Return a context manager that adds the time spent inside it
+		to a phase. If cpu is False, only the wall-clock time is
+		recorded (because other work is being done in the same
+		thread, as with asyncio)."""
+		start_wall = time.perf_counter()
+		start_cpu = time.thread_time()
+		try:
+			yield
+		finally:
+			used_cpu = 0.0
+			if cpu:
+				used_cpu = time.thread_time() - start_cpu
+			self.add(name, time.perf_counter() - start_wall, used_cpu, feed)
+
+	def call_hook_function(self, hookname, func, args):
+		"""Call a hook function, adding the time it takes to the total
+		for it."""
+		start_wall = time.perf_counter()
+		start_cpu = time.thread_time()
+		try:
+			return func(*args)
+		finally:
+			wall = time.perf_counter() - start_wall
+			cpu = time.thread_time() - start_cpu
+			with self.lock:
+				add_total(self.hooks, hookname + " " + get_function_name(func), wall, cpu)
+
+	def get_report(self):
+		"""Return the timings as a dict that can be written as JSON."""
+		with self.lock:
+			return {
+				"total": {
+					"wall": time.perf_counter() - self.start_wall,
+					"cpu": time.process_time() - self.start_cpu,
+					},
+				"phases": totals_to_dict(self.phases),
+				"feeds": dict([(url, totals_to_dict(totals)) for (url, totals) in self.feeds.items()]),
+				"hooks": totals_to_dict(self.hooks),
+				}
+
+	def write_report(self, filename):
+		"""Write the timings to a file as JSON."""
+		f = open(filename, "w")
+		json.dump(self.get_report(), f, indent=1, sort_keys=True)
+		f.write("\n")
+		f.close()
+
+	def log_summary(self, log, max_items=10):
+		"""Log a summary of the timings, with the phases and hook
+		functions that took longest, and the slowest feeds."""
+		report = self.get_report()
+		log("Timing: %.3f s wall, %.3f s CPU in total" % (report["total"]["wall"], report["total"]["cpu"]))
+		for name, total in get_slowest(report["phases"], len(report["phases"])):
+			log("Timing: %s: %.3f s wall, %.3f s CPU, count %d"
+			    % (name, total["wall"], total["cpu"], total["count"]))
+		for name, total in get_slowest(report["hooks"], max_items):
+			log("Timing: hook %s: %.3f s wall, %.3f s CPU, count %d"
+			    % (name, total["wall"], total["cpu"], total["count"]))
+		feed_totals = {}
+		for url, totals in report["feeds"].items():
+			feed_totals[url] = {
+				"wall": sum([total["wall"] for total in totals.values()]),
+				"cpu": sum([total["cpu"] for total in totals.values()]),
+				}
+		for url, total in get_slowest(feed_totals, max_items):
+			log("Timing: feed %s: %.3f s wall, %.3f s CPU" % (url, total["wall"], total["cpu"]))
+
+def add_total(totals, key, wall, cpu):
+	"""Add to the [count, wall, cpu] list for key in totals."""
+	total = totals.get(key)
+	if total is None:
+		totals[key] = [1, wall, cpu]
+	else:
+		total[0] += 1
+		total[1] += wall
+		total[2] += cpu
+
+def totals_to_dict(totals):
+	return dict([(key, {"count": count, "wall": wall, "cpu": cpu})
+	             for (key, (count, wall, cpu)) in totals.items()])
+
+def get_slowest(totals, max_items):
+	"""Return the max_items (key, total) pairs with the most wall-clock
+	time from a dict of totals."""
+	items = sorted(totals.items(), key=lambda item: (-item[1]["wall"], item[0]))
+	return items[:max_items]
+
+def get_function_name(func):
+	"""Describe a function well enough to tell which plugin it's from."""
+	name = getattr(func, "__qualname__", None) or repr(func)
+	code = getattr(func, "__code__", None)
+	if code is not None:
+		name = os.path.basename(code.co_filename) + ":" + name
+	return name
+
+# The Timings for this run, or None if timing is turned off.
+timings = None
+
+NOT_TIMING = contextlib.nullcontext()
+
+def start():
+	"""Turn timing on."""
+	global timings
+	timings = Timings()
+	return timings
+
+def phase(name, feed=None, cpu=True):
+	"""As Timings.phase, if timing is turned on."""
+	if timings is None:
+		return NOT_TIMING
+	return timings.phase(name, feed, cpu)
+
+def add(name, wall, cpu, feed=None):
+	"""As Timings.add, if timing is turned on."""
+	if timings is not None:
+		timings.add(name, wall, cpu, feed)
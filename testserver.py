@@ -41,6 +41,13 @@ class TimeoutServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     """HTTP request handler for rawdog's test suite."""
 
+    # Support keep-alive connections. This means that every response
+    # must have a Content-Length.
+    protocol_version = "HTTP/1.1"
+
+    # Extra headers to send with the response.
+    extra_headers = []
+
     # do_GET/do_HEAD are copied from SimpleHTTPServer because send_head isn't
     # part of the API.
 
@@ -55,7 +62,14 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         if f:
             f.close()
 
+    def end_headers(self):
+        for name, value in self.extra_headers:
+            self.send_header(name, value)
+        http.server.SimpleHTTPRequestHandler.end_headers(self)
+
     def send_head(self):
+        self.extra_headers = []
+
         # Look for lines of the form "/oldpath /newpath" in .rewrites.
         try:
             f = open(os.path.join(self.server.files_dir, ".rewrites"))
@@ -73,6 +87,7 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             auth = "Basic " + base64.b64encode((m.group(1) + ":" + m.group(2)).encode()).decode()
             if self.headers.get("Authorization") != auth:
                 self.send_response(401)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
             self.path = m.group(3)
@@ -94,10 +109,30 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_header("WWW-Authenticate",
                                  'Digest realm="%s", nonce="%s"'
                                      % (realm, nonce))
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
             self.path = m.group(3)
 
+        while True:
+            m = re.match(r'^/(maxage|retryafter|delay)-(\d+)(/.*)$', self.path)
+            if not m:
+                break
+            if m.group(1) == "delay":
+                # Request for a response delayed by some milliseconds.
+                # Record when each one started and finished, so tests can
+                # check how requests overlapped.
+                start = time.time()
+                time.sleep(int(m.group(2)) / 1000.0)
+                with open(os.path.join(self.server.files_dir, ".delays"), "a") as f:
+                    f.write("%f %f %s\n" % (start, time.time(), self.path))
+            elif m.group(1) == "maxage":
+                # Request for caching hints in the response.
+                self.extra_headers.append(("Cache-Control", "max-age=" + m.group(2)))
+            else:
+                self.extra_headers.append(("Retry-After", m.group(2)))
+            self.path = m.group(3)
+
         m = re.match(r'^/(\d\d\d)(/.*)?$', self.path)
         if m:
             # Request for a particular response code.
@@ -112,6 +147,7 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 else:
                     dest = self.server.base_url + dest
                 self.send_header("Location", dest)
+            self.send_header("Content-Length", "0")
             self.end_headers()
             return None
 
@@ -130,6 +166,7 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 f = open(filename, "rb")
             except IOError:
                 self.send_response(404)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
 
@@ -140,6 +177,7 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             # Oversimplistic, but matches what feedparser sends.
             if self.headers.get("If-None-Match", "") == etag:
                 self.send_response(304)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return None
 
@@ -177,6 +215,7 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
         # A request we can't handle.
         self.send_response(500)
+        self.send_header("Content-Length", "0")
         self.end_headers()
         return None
 
@@ -185,9 +224,11 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         f.write(fmt % args + "\n")
         f.close()
 
-class HTTPServer(http.server.HTTPServer):
+class HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
     """HTTP server for rawdog's test suite."""
 
+    daemon_threads = True
+
     def __init__(self, base_url, files_dir, *args, **kwargs):
         self.base_url = base_url
         self.files_dir = files_dir